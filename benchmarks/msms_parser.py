@@ -0,0 +1,102 @@
+"""Micro-benchmark for parsing MSMS .vert/.face output
+
+Writes a synthetic MSMS output split into components, with vertex and face
+counts in the range of a large protein surface, then times the previous
+per-line parser against plugin.msms.read_msms_output.
+
+    python benchmarks/msms_parser.py --vertices 1000000 --components 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from plugin.msms import msms_output_names, read_msms_output  # noqa: E402
+
+
+def write_msms_output(output_name, num_vertices, num_components, num_atoms=100000):
+    rng = np.random.default_rng(0)
+    per_component = num_vertices // num_components
+    for component in range(num_components):
+        name = output_name if component == 0 else f'{output_name}_{component}'
+        pos = rng.uniform(-60, 60, (per_component, 3))
+        nrm = rng.normal(size=(per_component, 3))
+        nrm /= np.linalg.norm(nrm, axis=1)[:, None]
+        atom = rng.integers(1, num_atoms + 1, per_component)
+        with open(name + '.vert', 'w') as f:
+            f.write('# MSMS solvent excluded surface vertices for synthetic.xyzr\n')
+            f.write('#vertex #sphere density probe_r\n')
+            rows = np.column_stack((pos, nrm))
+            lines = ''.join(
+                '%9.3f %9.3f %9.3f %7.3f %7.3f %7.3f %7d %7d %2d\n' % (*row, 0, a, 2)
+                for row, a in zip(rows.tolist(), atom.tolist()))
+            f.write(lines)
+        tri = rng.integers(1, per_component + 1, (per_component * 2, 3))
+        with open(name + '.face', 'w') as f:
+            f.write('# MSMS solvent excluded surface faces for synthetic.xyzr\n')
+            f.write('#faces #sphere density probe_r\n')
+            f.write(''.join('%6d %6d %6d %2d %6d\n' % (a, b, c, 1, 1) for a, b, c in tri.tolist()))
+
+
+def read_msms_output_legacy(output_name):
+    # per-line parser previously used in SurfaceInstance.compute_msms
+    vertices, normals, indices, triangles = [], [], [], []
+    for name in msms_output_names(output_name):
+        vertex_offset = len(vertices) // 3
+        with open(name + '.vert', 'r') as f:
+            for l in f.readlines():
+                if l.startswith('#'):
+                    continue
+                s = l.split()
+                vertices += map(float, s[0:3])
+                normals += map(float, s[3:6])
+                indices.append(int(s[7]) - 1)
+        with open(name + '.face', 'r') as f:
+            for l in f.readlines():
+                if l.startswith('#'):
+                    continue
+                s = l.split()
+                triangles += [int(x) - 1 + vertex_offset for x in s[0:3]]
+    return vertices, normals, indices, triangles
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vertices', type=int, default=1000000)
+    parser.add_argument('--components', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_name = os.path.join(temp_dir, 'msms')
+        write_msms_output(output_name, args.vertices, args.components)
+        size = sum(os.path.getsize(os.path.join(temp_dir, f)) for f in os.listdir(temp_dir))
+        print(f'{args.vertices} vertices in {args.components} components, {size / 1e6:.1f} MB')
+
+        legacy_time, legacy = best_of(lambda: read_msms_output_legacy(output_name), args.repeat)
+        bulk_time, bulk = best_of(lambda: read_msms_output(output_name), args.repeat)
+
+    vertices, normals, indices, triangles = bulk
+    assert np.allclose(vertices.ravel(), legacy[0], atol=1e-3)
+    assert np.array_equal(indices, legacy[2])
+    assert np.array_equal(triangles.ravel(), legacy[3])
+
+    print(f'legacy: {legacy_time:.3f}s')
+    print(f'bulk:   {bulk_time:.3f}s ({legacy_time / bulk_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
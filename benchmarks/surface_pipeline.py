@@ -0,0 +1,197 @@
+"""Benchmark of the SurfaceInstance pipeline without a Nanome session
+
+Builds synthetic structures of the given atom counts (or loads PDB files),
+generates their surfaces with MSMS and AOEmbree run as local processes, then
+recolors them with every color scheme. Without a plugin connection, mesh
+uploads are counted instead of sent.
+
+Each case runs in a fresh process, and reports per-stage wall time, peak RSS of
+the plugin and its subprocesses, subprocess CPU time, vertex and triangle counts
+and upload bytes. Results are written as JSON to compare runs.
+
+    python benchmarks/surface_pipeline.py --atoms 1000 10000 100000 --output results.json
+    python benchmarks/surface_pipeline.py --pdb 4hhb.pdb --modes all chain residue --ao native
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# atoms per cubic angstrom in a folded protein, and atoms per residue
+ATOM_DENSITY = 0.05
+RESIDUE_SIZE = 8
+RESIDUE_NAMES = ['ALA', 'ARG', 'ASP', 'GLY', 'LEU', 'LYS', 'PHE', 'SER', 'TRP', 'VAL']
+ELEMENTS = ['C', 'C', 'C', 'N', 'O', 'S']
+ELEMENT_RADII = {'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8}
+
+
+def make_atoms(num_atoms, num_chains, seed=0):
+    """Returns stand-in atoms packed in a globule, with chains and residues as contiguous slabs"""
+    rng = np.random.default_rng(seed)
+    radius = (3 * num_atoms / (4 * np.pi * ATOM_DENSITY)) ** (1 / 3)
+    directions = rng.normal(size=(num_atoms, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    positions = directions * radius * rng.random(num_atoms)[:, None] ** (1 / 3)
+    positions = positions[np.argsort(positions[:, 0])]
+
+    chains = [SimpleNamespace(name=chr(ord('A') + i % 26) + str(i // 26 or '')) for i in range(num_chains)]
+    atoms = []
+    residue = None
+    for i, position in enumerate(positions.tolist()):
+        chain = chains[i * num_chains // num_atoms]
+        if i % RESIDUE_SIZE == 0:
+            residue = SimpleNamespace(
+                serial=i // RESIDUE_SIZE,
+                name=RESIDUE_NAMES[(i // RESIDUE_SIZE) % len(RESIDUE_NAMES)],
+                secondary_structure=(i // (RESIDUE_SIZE * 10)) % 4)
+        symbol = ELEMENTS[i % len(ELEMENTS)]
+        atoms.append(SimpleNamespace(
+            position=position, vdw_radius=ELEMENT_RADII[symbol], symbol=symbol, chain=chain, residue=residue))
+    return atoms
+
+
+def load_pdb_atoms(path):
+    from nanome.api.structure import Complex
+    complex = Complex.io.from_pdb(path=path)
+    return list(complex.atoms)
+
+
+def stage_times(stages, end):
+    times = {}
+    for (stage, start), (_, stop) in zip(stages, stages[1:] + [('', end)]):
+        if stage:
+            times[stage] = times.get(stage, 0) + stop - start
+    return times
+
+
+async def run_surface(surface, mode, ao_engine):
+    from plugin.SurfaceInstance import COLOR_BY_OPTIONS
+
+    await surface.generate(
+        by_residue=mode == 'residue', by_chain=mode == 'chain',
+        ao=ao_engine != 'none', ao_engine=None if ao_engine == 'none' else ao_engine)
+
+    recolor = {}
+    for name, color_by in COLOR_BY_OPTIONS:
+        surface.color_by = color_by
+        start = time.perf_counter()
+        await surface.apply_color()
+        recolor[name] = time.perf_counter() - start
+    return recolor
+
+
+def run_case(case):
+    # a fresh cache directory per case, set before the plugin modules read it
+    os.environ['SURFACE_CACHE_DIR'] = case['cache_dir']
+    from plugin import SurfaceInstance as surface_module
+    from plugin.SurfaceInstance import SurfaceInstance
+    if case['msms_path']:
+        surface_module.MSMS_PATH = case['msms_path']
+    if case['ao_path']:
+        surface_module.AO_PATH = case['ao_path']
+
+    start = time.perf_counter()
+    atoms = load_pdb_atoms(case['pdb']) if case['pdb'] else make_atoms(case['atoms'], case['chains'])
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    surface = SurfaceInstance(case['name'], 0, atoms)
+    index_time = time.perf_counter() - start
+    stages = []
+    surface.on_stage_changed = lambda s: stages.append((s.stage, time.perf_counter()))
+
+    start = time.perf_counter()
+    recolor = asyncio.run(run_surface(surface, case['mode'], case['ao_engine']))
+    end = time.perf_counter()
+    generate_time = end - start - sum(recolor.values())
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss_scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        **{k: case[k] for k in ('name', 'mode', 'ao_engine')},
+        'atoms': surface.attributes.count,
+        'vertices': surface.num_vertices,
+        'triangles': len(surface.triangles),
+        'lods': [len(lod['triangles']) for lod in surface.lods],
+        'uploads': surface.mesh.uploads,
+        'upload_bytes': surface.mesh.upload_bytes,
+        'scratch_bytes_written': surface.workspace.bytes_written,
+        'scratch_bytes_read': surface.workspace.bytes_read,
+        'time': {
+            'load': load_time,
+            'index_atoms': index_time,
+            'generate': generate_time,
+            'stages': stage_times(stages, start + generate_time),
+            'recolor': recolor,
+        },
+        'peak_rss_bytes': own.ru_maxrss * rss_scale,
+        'subprocess_peak_rss_bytes': children.ru_maxrss * rss_scale,
+        'subprocess_cpu_seconds': children.ru_utime + children.ru_stime,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--atoms', type=int, nargs='*', default=[1000, 10000, 100000])
+    parser.add_argument('--chains', type=int, default=4)
+    parser.add_argument('--pdb', nargs='*', default=[], help='PDB files to benchmark, in addition to --atoms')
+    parser.add_argument('--modes', nargs='+', choices=['all', 'chain', 'residue'], default=['all', 'chain'])
+    parser.add_argument('--ao', choices=['embree', 'native', 'none'], default='embree')
+    parser.add_argument('--msms-path', help='MSMS executable, defaults to the bundled one')
+    parser.add_argument('--ao-path', help='AOEmbree executable, defaults to the bundled one')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    inputs = [dict(name=f'synthetic-{n}', atoms=n, chains=args.chains, pdb=None) for n in args.atoms]
+    inputs += [dict(name=os.path.basename(path), atoms=None, chains=None, pdb=path) for path in args.pdb]
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i, (item, mode) in enumerate((item, mode) for item in inputs for mode in args.modes):
+            case = dict(
+                item, mode=mode, ao_engine=args.ao, msms_path=args.msms_path, ao_path=args.ao_path,
+                cache_dir=os.path.join(temp_dir, f'cache-{i}'))
+            # a process per case, so peak memory and child process usage are per case
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    result = pool.submit(run_case, case).result()
+                except Exception as e:
+                    result = dict(name=case['name'], mode=mode, ao_engine=args.ao, error=str(e))
+            results.append(result)
+
+            if 'error' in result:
+                print(f"{result['name']:>20} {mode:>8}  failed: {result['error']}")
+            else:
+                print(
+                    f"{result['name']:>20} {mode:>8}  {result['atoms']:>7} atoms  {result['vertices']:>8} vertices  "
+                    f"{result['time']['generate']:7.2f}s  {result['peak_rss_bytes'] / 2 ** 20:7.0f} MB")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'created': datetime.now(timezone.utc).isoformat(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'cases': results,
+        }, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
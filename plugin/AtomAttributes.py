@@ -0,0 +1,54 @@
+import numpy as np
+
+from .utils import natural_sorted
+
+# radius used for atoms without a known vdw radius (carbon)
+DEFAULT_RADIUS = 1.7
+
+
+class AtomAttributes:
+    """Integer coded per-atom attributes, built in one pass over the SDK atoms
+
+    Coded attributes index into their name lists, e.g. chain_names[chain[i]] is the chain of atom i.
+    Chain codes follow natural sort order of the chain names.
+    """
+
+    def __init__(self, atoms: 'list'):
+        self.count = len(atoms)
+        self.xyzr = np.empty((self.count, 4), dtype=np.float64)
+        residue_serials = []
+        chain_names = []
+        residue_names = []
+        symbols = []
+        secondary_structure = []
+
+        for i, atom in enumerate(atoms):
+            self.xyzr[i, 0:3] = tuple(atom.position)
+            self.xyzr[i, 3] = atom.vdw_radius
+            residue_serials.append(atom.residue.serial)
+            chain_names.append(atom.chain.name)
+            residue_names.append(atom.residue.name)
+            symbols.append(atom.symbol)
+            secondary_structure.append(int(atom.residue.secondary_structure))
+
+        # replace unknown atoms with carbon
+        self.xyzr[self.xyzr[:, 3] < 0.0001, 3] = DEFAULT_RADIUS
+
+        self.residue_serial = np.array(residue_serials, dtype=np.int64)
+        self.secondary_structure = np.array(secondary_structure, dtype=np.int8)
+        self.chain_names = natural_sorted(set(chain_names))
+        self.chain = self.encode(chain_names, self.chain_names)
+        self.residue_names = sorted(set(residue_names))
+        self.residue_name = self.encode(residue_names, self.residue_names)
+        self.elements = sorted(set(symbols))
+        self.element = self.encode(symbols, self.elements)
+
+    @staticmethod
+    def encode(values, names):
+        code = {name: i for i, name in enumerate(names)}
+        return np.array([code[value] for value in values], dtype=np.int32)
+
+    def hydrophobicity(self, scale: 'dict[str, float]'):
+        """Returns per-atom hydrophobicity from a residue name scale, nan for unknown residues"""
+        table = np.array([scale.get(name, np.nan) for name in self.residue_names], dtype=np.float32)
+        return table[self.residue_name]
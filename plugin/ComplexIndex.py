@@ -0,0 +1,85 @@
+import numpy as np
+from nanome.api.structure import Atom, Complex
+
+WATER_ELEMENTS = [['O'], ['H', 'H', 'O']]
+
+
+class ComplexIndex:
+    """Per-atom flags of a complex, built in one linear pass
+
+    Atoms are stored in chain order, so each chain is a contiguous range and
+    selection filters become boolean mask operations.
+    """
+
+    def __init__(self, complex: Complex):
+        self.atoms: list[Atom] = []
+        # a list per name, complexes can have several chains with the same name
+        self.chain_ranges: dict[str, list[tuple[int, int]]] = {}
+        is_hydrogen = []
+        is_water = []
+        is_selected = []
+        residue_ids = []
+
+        residue_id = 0
+        for chain in complex.chains:
+            start = len(self.atoms)
+            for residue in chain.residues:
+                atoms = list(residue.atoms)
+                water = len(atoms) <= 3 and sorted(a.symbol for a in atoms) in WATER_ELEMENTS
+                residue_id += 1
+                for atom in atoms:
+                    self.atoms.append(atom)
+                    is_hydrogen.append(atom.symbol == 'H')
+                    is_water.append(water)
+                    is_selected.append(atom.selected)
+                    residue_ids.append(residue_id)
+            self.chain_ranges.setdefault(chain.name, []).append((start, len(self.atoms)))
+
+        self.is_hydrogen = np.array(is_hydrogen, dtype=bool)
+        self.is_water = np.array(is_water, dtype=bool)
+        self.is_selected = np.array(is_selected, dtype=bool)
+        self.residue_id = np.array(residue_ids, dtype=np.int64)
+
+        self.chain_has_hydrogens = {name: self.any_in_chain(name, self.is_hydrogen) for name in self.chain_ranges}
+        self.chain_has_waters = {name: self.any_in_chain(name, self.is_water) for name in self.chain_ranges}
+
+    def any_in_chain(self, name, flags: np.ndarray):
+        return any(flags[start:end].any() for start, end in self.chain_ranges[name])
+
+    def chain_mask(self, chains: 'set[str]'):
+        mask = np.zeros(len(self.atoms), dtype=bool)
+        for name in chains:
+            for start, end in self.chain_ranges.get(name, []):
+                mask[start:end] = True
+        return mask
+
+    def filter_mask(self, include_hydrogens, include_waters, selection_only):
+        mask = np.ones(len(self.atoms), dtype=bool)
+        if not include_hydrogens:
+            mask &= ~self.is_hydrogen
+        if not include_waters:
+            mask &= ~self.is_water
+        if selection_only:
+            mask &= self.is_selected
+        return mask
+
+    def get_atoms(self, mask: np.ndarray):
+        return [self.atoms[i] for i in np.flatnonzero(mask)]
+
+    @staticmethod
+    def count_runs(ids: np.ndarray):
+        # residue ids increase along the atoms, so count the steps
+        return int(np.count_nonzero(ids[1:] != ids[:-1])) + (len(ids) > 0)
+
+    def count_residues(self, mask: np.ndarray):
+        return self.count_runs(self.residue_id[mask])
+
+    def count_chain(self, name, mask: np.ndarray):
+        """Returns the number of atoms and residues of a chain passing a filter mask"""
+        num_atoms = 0
+        num_residues = 0
+        for start, end in self.chain_ranges.get(name, []):
+            chain_mask = mask[start:end]
+            num_atoms += int(np.count_nonzero(chain_mask))
+            num_residues += self.count_runs(self.residue_id[start:end][chain_mask])
+        return num_atoms, num_residues
@@ -1,16 +1,28 @@
 import gc
 import os
 
+import numpy as np
+
 import nanome
 from nanome import ui
-from nanome.api.structure import Atom, Complex
+from nanome.api.structure import Complex
 from nanome.util import async_callback, enums, Color
 
-from .SurfaceInstance import COLOR_BY_OPTIONS, COLOR_BY_CAN_USE_CUSTOM, COLOR_PRESETS, SurfaceInstance
-from .utils import natural_sorted
+from .ComplexIndex import ComplexIndex
+from .planner import estimate_vertices, plan_densities
+from .SurfaceInstance import COLOR_BY_OPTIONS, COLOR_BY_CAN_USE_CUSTOM, COLOR_PRESETS, MSMS_DENSITY, SurfaceInstance
+from .SurfaceStore import SurfaceStore, get_presenter_dir
+from .utils import available_memory, natural_sorted, run_in_worker
 
+# atom limit when the available memory is unknown, and the lowest limit otherwise
 MAX_ATOM_COUNT = 100000
+# rough peak memory of the surface pipeline per atom, MSMS output and mesh upload included
+SURFACE_BYTES_PER_ATOM = 20000
 MAX_RESIDUE_COUNT = 1000
+# total triangles of the visible surfaces, above it large surfaces switch to a lower level of detail
+VISIBLE_TRIANGLE_BUDGET = 4000000
+# show a low density preview first for selections larger than this
+PROGRESSIVE_ATOM_COUNT = 20000
 
 BASE_DIR = os.path.join(os.path.dirname(__file__))
 MENU_PATH = os.path.join(BASE_DIR, 'assets/menu.json')
@@ -25,8 +37,11 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         self.set_plugin_list_button(self.PluginListButtonType.run, 'Open')
 
         self.selected_complex: Complex = None
+        self.complex_index: ComplexIndex = None
         self.selected_chains: set[str] = set()
-        self.selected_atoms: list[Atom] = []
+        # filter mask over the complex index, and atom/residue counts per selected chain
+        self.filter_mask: np.ndarray = None
+        self.chain_counts: dict[str, tuple[int, int]] = {}
 
         self.include_hydrogens = False
         self.include_waters = False
@@ -38,15 +53,31 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         self.selected_surface_btn: ui.Button = None
         self.selected_surface: SurfaceInstance = None
         self.surfaces: list[SurfaceInstance] = []
+        # entries already checked for saved surfaces
+        self.restore_checked: set[int] = set()
+        # disabled until the presenter is known
+        self.surface_store = SurfaceStore()
 
         self.create_menu()
         self.on_run()
+        self.open_surface_store()
 
     @async_callback
     async def on_run(self):
         self.menu.enabled = True
         self.update_menu(self.menu)
 
+    @async_callback
+    async def open_surface_store(self):
+        # surfaces are saved per presenter, so they are never restored into another user's workspace
+        presenter = await self.request_presenter_info()
+        store_dir = get_presenter_dir(presenter.account_id if presenter else None)
+        if store_dir is None:
+            return
+        self.surface_store = SurfaceStore(store_dir)
+        self.restore_checked.clear()
+        self.update_entry_list()
+
     def on_complex_list_changed(self):
         self.update_entry_list()
 
@@ -127,6 +158,7 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         self.ln_color_options: ui.LayoutNode = root.find_node('Color Options')
         self.ln_no_surface: ui.LayoutNode = root.find_node('No Surface')
         self.ln_surface_generating: ui.LayoutNode = root.find_node('Surface Generating')
+        self.lbl_surface_generating: ui.Label = self.ln_surface_generating.get_content()
         self.ln_custom_color: ui.LayoutNode = root.find_node('Custom Color')
         self.ln_no_color: ui.LayoutNode = root.find_node('No Color')
 
@@ -199,6 +231,7 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         indices = [complex.index for complex in complexes]
         if self.selected_complex and self.selected_complex.index not in indices:
             self.selected_complex = None
+            self.complex_index = None
             self.selected_chains.clear()
             self.ln_no_entry.enabled = True
             self.ln_chains.enabled = False
@@ -211,9 +244,52 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
                 update_surface_list = True
                 self.surfaces.remove(surface)
                 surface.destroy()
+                await self.surface_store.release(surface)
         if update_surface_list:
             self.update_surface_list()
 
+        self.restore_checked &= set(indices)
+        for complex in complexes:
+            if complex.index not in self.restore_checked:
+                self.restore_checked.add(complex.index)
+                await self.restore_surfaces(complex)
+
+    async def restore_surfaces(self, complex: Complex):
+        """Shows the saved surfaces of an entry from before a reconnect, if its atoms are unchanged"""
+        saved = await self.surface_store.find(complex.index, complex.full_name)
+        if not saved:
+            return
+        complexes = await self.request_complexes([complex.index])
+        if not complexes or complexes[0] is None:
+            return
+        index = ComplexIndex(complexes[0])
+
+        restored = False
+        for path, meta in saved:
+            surface = None
+            try:
+                state, arrays = await run_in_worker(self.surface_store.load, path)
+                ordinals = arrays['atoms']
+                if len(ordinals) and ordinals.max() >= len(index.atoms):
+                    continue
+                surface = SurfaceInstance(state['name'], complex.index, [index.atoms[i] for i in ordinals.tolist()])
+                # the entry was edited since
+                if surface.fingerprint != state['fingerprint']:
+                    continue
+                surface.on_stage_changed = self.update_surface_stage
+                await surface.restore(state, arrays)
+            except Exception as e:
+                nanome.util.Logs.warning(f'Failed to restore saved surface {path}: {e}')
+                if surface:
+                    surface.destroy()
+                continue
+            await self.surface_store.adopt(surface, path, meta)
+            self.surfaces.append(surface)
+            restored = True
+        if restored:
+            self.update_surface_list()
+            self.update_lods()
+
     @async_callback
     async def select_entry(self, dd: ui.Dropdown, ddi: ui.DropdownItem):
         self.ln_no_entry.enabled = False
@@ -225,10 +301,12 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
             if self.selected_complex and complex.index != self.selected_complex.index:
                 return
             self.selected_complex = complex
+            self.complex_index = ComplexIndex(complex)
             self.update_selection()
 
         complexes = await self.request_complexes([ddi.index])
         self.selected_complex: Complex = complexes[0]
+        self.complex_index = ComplexIndex(self.selected_complex)
         self.selected_complex.register_complex_updated_callback(update_complex)
         self.selected_complex.register_selection_changed_callback(update_complex)
         self.selected_chains = set()
@@ -251,37 +329,43 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
     def select_chain(self, btn: ui.Button):
         if btn.selected:
             self.selected_chains.add(btn.chain)
+            self.count_chain(btn.chain)
         else:
-            self.selected_chains.remove(btn.chain)
+            self.selected_chains.discard(btn.chain)
+            self.chain_counts.pop(btn.chain, None)
 
-        all_selected = len(self.selected_chains) == len(list(self.selected_complex.chains))
+        all_selected = len(self.selected_chains) == len(self.complex_index.chain_ranges)
         self.btn_all_chains.selected = all_selected
         self.update_content(btn, self.btn_all_chains)
-        self.update_selection()
+        self.update_selection_label()
 
     def toggle_all_chains(self, btn: ui.Button):
         if btn.selected:
-            self.selected_chains = set(chain.name for chain in self.selected_complex.chains)
+            added = set(self.complex_index.chain_ranges) - self.selected_chains
+            self.selected_chains |= added
+            for chain in added:
+                self.count_chain(chain)
         else:
             self.selected_chains.clear()
+            self.chain_counts.clear()
 
         for ln in self.lst_chains.items:
             ln.get_content().selected = btn.selected
 
         self.update_content(self.lst_chains)
-        self.update_selection()
+        self.update_selection_label()
 
     def toggle_include_hydrogens(self, btn: ui.Button):
         self.include_hydrogens = btn.selected
-        self.update_selection()
+        self.update_filter(lambda index: index.is_hydrogen)
 
     def toggle_include_waters(self, btn: ui.Button):
         self.include_waters = btn.selected
-        self.update_selection()
+        self.update_filter(lambda index: index.is_water)
 
     def toggle_selection_only(self, btn: ui.Button):
         self.selection_only = btn.selected
-        self.update_selection()
+        self.update_filter(lambda index: ~index.is_selected)
 
     def toggle_compute_by_residue(self, btn: ui.Button):
         self.compute_by_residue = btn.selected
@@ -289,7 +373,7 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
             self.compute_by_chain = False
             self.btn_compute_by_chain.selected = False
             self.update_content(self.btn_compute_by_chain)
-        self.update_selection()
+        self.update_selection_label()
 
     def toggle_compute_by_chain(self, btn: ui.Button):
         self.compute_by_chain = btn.selected
@@ -297,15 +381,64 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
             self.compute_by_residue = False
             self.btn_compute_by_residue.selected = False
             self.update_content(self.btn_compute_by_residue)
-        self.update_selection()
+        self.update_selection_label()
 
     def toggle_ambient_occlusion(self, btn: ui.Button):
         self.ambient_occlusion = btn.selected
 
     def update_selection(self):
-        num_atoms = 0
-        num_residues = 0
-        self.selected_atoms = []
+        # full recount, after the entry or its atoms changed
+        self.chain_counts.clear()
+        if self.complex_index:
+            self.filter_mask = self.complex_index.filter_mask(
+                self.include_hydrogens, self.include_waters, self.selection_only)
+            for chain in self.selected_chains:
+                self.count_chain(chain)
+        self.update_selection_label()
+
+    def update_filter(self, get_changed):
+        """Recounts only the selected chains containing atoms affected by a filter toggle
+
+        get_changed returns the flags of the affected atoms from the complex index, which may not exist yet.
+        """
+        if not self.complex_index:
+            self.update_selection_label()
+            return
+        index = self.complex_index
+        changed = get_changed(index)
+        self.filter_mask = index.filter_mask(self.include_hydrogens, self.include_waters, self.selection_only)
+        for chain in self.selected_chains:
+            if index.any_in_chain(chain, changed):
+                self.count_chain(chain)
+        self.update_selection_label()
+
+    def count_chain(self, chain: str):
+        self.chain_counts[chain] = self.complex_index.count_chain(chain, self.filter_mask)
+
+    def get_selected_mask(self):
+        return self.complex_index.chain_mask(self.selected_chains) & self.filter_mask
+
+    @staticmethod
+    def get_max_atom_count():
+        # large selections are surfaced in blocks, so memory is the limit
+        memory = available_memory()
+        return MAX_ATOM_COUNT if memory is None else max(MAX_ATOM_COUNT, memory // SURFACE_BYTES_PER_ATOM)
+
+    def estimate_surface(self, num_atoms, num_residues):
+        """Returns the planned MSMS density and estimated vertex count of the selection"""
+        if self.compute_by_residue and num_residues:
+            fragment_sizes = [num_atoms / num_residues] * num_residues
+        elif self.compute_by_chain:
+            fragment_sizes = [atoms for atoms, _ in self.chain_counts.values() if atoms]
+        else:
+            fragment_sizes = [num_atoms]
+        densities = plan_densities(fragment_sizes, MSMS_DENSITY)
+        return (densities[0] if densities else MSMS_DENSITY), estimate_vertices(fragment_sizes, densities)
+
+    def update_selection_label(self):
+        max_atoms = self.get_max_atom_count()
+        num_atoms = sum(atoms for atoms, _ in self.chain_counts.values())
+        num_residues = sum(residues for _, residues in self.chain_counts.values())
         has_hydrogens = False
         has_waters = False
 
@@ -314,38 +447,25 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         elif not self.selected_chains:
             self.lbl_selection.text_value = 'Select one or more chains'
         else:
-            selected_residues = set()
+            index = self.complex_index
+            has_hydrogens = any(index.chain_has_hydrogens.get(chain) for chain in self.selected_chains)
+            has_waters = any(index.chain_has_waters.get(chain) for chain in self.selected_chains)
+
             num_chains = len(self.selected_chains)
-            for chain in self.selected_complex.chains:
-                if chain.name not in self.selected_chains:
-                    continue
-                for atom in chain.atoms:
-                    if atom.symbol == 'H':
-                        has_hydrogens = True
-                        if not self.include_hydrogens:
-                            continue
-                    if atom.symbol in ['H', 'O']:
-                        elements = sorted(a.symbol for a in atom.residue.atoms)
-                        if elements == ['O'] or elements == ['H', 'H', 'O']:
-                            has_waters = True
-                            if not self.include_waters:
-                                continue
-                    if self.selection_only and not atom.selected:
-                        continue
-                    selected_residues.add(f'{chain.name}-{atom.residue.serial}')
-                    self.selected_atoms.append(atom)
-
-            num_atoms = len(self.selected_atoms)
-            num_residues = len(selected_residues)
             chains_text = f'{num_chains} chain{"s" if num_chains != 1 else ""} selected'
             residues_text = f'{num_residues} residue{"s" if num_residues != 1 else ""} selected'
             atoms_text = f'{num_atoms} atom{"s" if num_atoms != 1 else ""} selected'
             if self.compute_by_residue and num_residues > MAX_RESIDUE_COUNT:
                 residues_text = f'<color=#f00>{residues_text}</color>'
-            if num_atoms > MAX_ATOM_COUNT:
-                atoms_text = f'<color=#f00>{atoms_text}</color>'
-            self.lbl_selection.text_value = f'{chains_text}\n{residues_text}\n{atoms_text}'
-
+            if num_atoms > max_atoms:
+                atoms_text = f'<color=#f00>{atoms_text} (max {max_atoms})</color>'
+            density, num_vertices = self.estimate_surface(num_atoms, num_residues)
+            vertices_text = f'~{num_vertices:,} vertices'
+            if density < MSMS_DENSITY:
+                vertices_text += f' (density {density:g})'
+            self.lbl_selection.text_value = f'{chains_text}\n{residues_text}\n{atoms_text}\n{vertices_text}'
+
+        filter_reset = not has_hydrogens and self.include_hydrogens or not has_waters and self.include_waters
         self.btn_include_hydrogens.unusable = not has_hydrogens
         if not has_hydrogens:
             self.btn_include_hydrogens.selected = False
@@ -355,9 +475,13 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
             self.btn_include_waters.selected = False
             self.include_waters = False
         self.update_content(self.btn_include_hydrogens, self.btn_include_waters)
+        if filter_reset and self.complex_index:
+            # counts are unaffected, the selected chains have none of these atoms
+            self.filter_mask = self.complex_index.filter_mask(
+                self.include_hydrogens, self.include_waters, self.selection_only)
 
         too_many_residues = (self.compute_by_residue and num_residues > MAX_RESIDUE_COUNT)
-        self.btn_generate.unusable = num_atoms == 0 or num_atoms > MAX_ATOM_COUNT or too_many_residues
+        self.btn_generate.unusable = num_atoms == 0 or num_atoms > max_atoms or too_many_residues
         self.update_content(self.lbl_selection, self.btn_generate)
 
     @async_callback
@@ -365,19 +489,28 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         chain_names = ' '.join(natural_sorted(self.selected_chains))
         name = f'{self.selected_complex.full_name} <size=40%>{chain_names}</size>'
         index = self.selected_complex.index
+        complex_name = self.selected_complex.full_name
+
+        mask = self.get_selected_mask()
+        atoms = self.complex_index.get_atoms(mask)
 
         try:
-            surface = SurfaceInstance(name, index, self.selected_atoms)
+            surface = SurfaceInstance(name, index, atoms)
+            surface.on_stage_changed = self.update_surface_stage
             self.surfaces.append(surface)
             self.selected_surface = surface
             self.update_surface_list()
             self.change_tab(self.btn_tab2)
             self.select_surface(self.selected_surface_btn)
 
-            await surface.generate(self.compute_by_residue, self.compute_by_chain, self.ambient_occlusion)
+            progressive = len(atoms) > PROGRESSIVE_ATOM_COUNT
+            await surface.generate(
+                self.compute_by_residue, self.compute_by_chain, self.ambient_occlusion, progressive=progressive)
             if self.selected_surface == surface:
                 self.select_surface(self.selected_surface_btn)
             self.update_surface_list()
+            self.update_lods()
+            await self.surface_store.save(surface, index, complex_name, np.flatnonzero(mask))
         except Exception as e:
             if str(e) == 'Canceled':
                 return
@@ -452,36 +585,84 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
         self.ln_no_surface.enabled = False
         self.ln_color_options.enabled = surface.done
         self.ln_surface_generating.enabled = not surface.done
+        self.ln_applying_color.enabled = surface.recoloring and surface.visible
 
         if surface.done:
             self.update_color_dropdowns()
             self.update_color_inputs()
+        else:
+            self.set_surface_generating_text(surface)
 
         self.update_content(btn)
-        self.update_node(self.ln_no_surface, self.ln_color_options, self.ln_surface_generating)
+        self.update_node(self.ln_no_surface, self.ln_color_options, self.ln_surface_generating, self.ln_applying_color)
+
+    def set_surface_generating_text(self, surface: SurfaceInstance):
+        text = 'Generating, please wait...'
+        if surface.queue_position:
+            text += f'\n<size=70%>Queued, position {surface.queue_position}</size>'
+        elif surface.stage:
+            text += f'\n<size=70%>{surface.stage}</size>'
+        self.lbl_surface_generating.text_value = text
+
+    def update_surface_stage(self, surface: SurfaceInstance):
+        if surface != self.selected_surface or surface.done:
+            return
+        self.set_surface_generating_text(surface)
+        self.update_content(self.lbl_surface_generating)
 
-    def toggle_surface(self, btn: ui.Button):
+    @async_callback
+    async def toggle_surface(self, btn: ui.Button):
         btn.surface.toggle_visible()
         self.update_surface_list()
+        self.update_lods()
+        await self.surface_store.update(btn.surface)
 
-    def delete_surface(self, btn: ui.Button):
+    @async_callback
+    async def delete_surface(self, btn: ui.Button):
         btn.surface.destroy()
         self.surfaces.remove(btn.surface)
         self.update_surface_list()
+        self.update_lods()
         gc.collect()
+        await self.surface_store.remove(btn.surface)
 
-    def toggle_all_surfaces(self, btn: ui.Button):
+    @async_callback
+    async def toggle_all_surfaces(self, btn: ui.Button):
         show = btn.text.value.idle == 'Show All'
-        for surface in self.surfaces:
+        surfaces = self.surfaces[:]
+        for surface in surfaces:
             surface.toggle_visible(show)
         self.update_surface_list()
+        self.update_lods()
+        for surface in surfaces:
+            await self.surface_store.update(surface)
 
-    def delete_all_surfaces(self, btn: ui.Button):
-        for surface in self.surfaces:
+    @async_callback
+    async def update_lods(self):
+        """Lowers the detail of the largest visible surfaces until all fit in the triangle budget"""
+        visible = [s for s in self.surfaces if s.done and s.visible]
+        lods = {surface: 0 for surface in visible}
+        total = sum(s.get_lod_triangles(0) for s in visible)
+        while total > VISIBLE_TRIANGLE_BUDGET:
+            reducible = [s for s in visible if lods[s] < len(s.lods) - 1]
+            if not reducible:
+                break
+            surface = max(reducible, key=lambda s: s.get_lod_triangles(lods[s]))
+            total -= surface.get_lod_triangles(lods[surface]) - surface.get_lod_triangles(lods[surface] + 1)
+            lods[surface] += 1
+        for surface, lod in lods.items():
+            await surface.set_lod(lod)
+
+    @async_callback
+    async def delete_all_surfaces(self, btn: ui.Button):
+        surfaces = self.surfaces[:]
+        for surface in surfaces:
             surface.destroy()
         del self.surfaces[:]
         self.update_surface_list()
         gc.collect()
+        for surface in surfaces:
+            await self.surface_store.remove(surface)
 
     def select_color_by(self, dd: ui.Dropdown, ddi: ui.DropdownItem):
         old_can_use_custom = self.selected_surface.color_by in COLOR_BY_CAN_USE_CUSTOM
@@ -565,17 +746,24 @@ class HighQualitySurfaces(nanome.AsyncPluginInstance):
 
     @async_callback
     async def apply_color(self):
-        if self.selected_surface.visible:
-            self.ln_applying_color.enabled = True
-            self.update_node(self.ln_applying_color)
-        await self.selected_surface.apply_color()
-        if self.selected_surface.visible:
-            self.ln_applying_color.enabled = False
-            self.update_node(self.ln_applying_color)
+        surface = self.selected_surface
+        task = surface.request_recolor()
+        self.set_applying_color(surface)
+        await task
+        self.set_applying_color(surface)
+        await self.surface_store.update(surface)
+
+    def set_applying_color(self, surface: SurfaceInstance):
+        # follows the recolor scheduler of the selected surface
+        enabled = surface.recoloring and surface.visible
+        if surface != self.selected_surface or self.ln_applying_color.enabled == enabled:
+            return
+        self.ln_applying_color.enabled = enabled
+        self.update_node(self.ln_applying_color)
 
 
 def main():
-    plugin = nanome.Plugin("High Quality Surfaces", "Generate stunning publication-ready surface representations and coloring. Powered by MSMS and AOEmbree. Note that these surfaces do not save with the Nanome workspace.", "Computation", False)
+    plugin = nanome.Plugin("High Quality Surfaces", "Generate stunning publication-ready surface representations and coloring. Powered by MSMS and AOEmbree. Note that these surfaces do not save with the Nanome workspace, but are restored when the plugin reconnects.", "Computation", False)
     plugin.set_plugin_class(HighQualitySurfaces)
     plugin.run()
 
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+
+from nanome.util import Logs
+
+from .utils import available_memory
+
+JOB_MSMS = 'msms'
+JOB_AO = 'ao'
+JOB_CPU = 'cpu'
+
+# concurrent MSMS and AOEmbree processes, and worker pool jobs, for the whole plugin process
+JOB_LIMITS = {
+    JOB_MSMS: os.cpu_count() or 1,
+    JOB_AO: 1,
+    JOB_CPU: os.cpu_count() or 1,
+}
+# memory kept free for the app and other plugins when starting a job
+MIN_FREE_MEMORY = 512 * 1024 ** 2
+# interactive work such as recoloring goes before all surface jobs, which are prioritized by size
+PRIORITY_INTERACTIVE = 0
+
+
+class JobScheduler:
+    """Limits concurrent jobs per kind, handing free slots to the waiting job with the lowest priority value
+
+    Jobs belong to an owner, which gets on_queue_changed() calls while it waits, and can be canceled as a whole.
+    Jobs needing more memory than available are deferred until another job finishes, or rejected if none runs.
+    """
+
+    def __init__(self, limits=JOB_LIMITS):
+        self.limits = dict(limits)
+        self.running = {kind: 0 for kind in limits}
+        # heap of [priority, order, future, owner] per kind
+        self.waiting: dict[str, list] = {kind: [] for kind in limits}
+        self.order = itertools.count()
+        self.released = asyncio.Event()
+
+    @asynccontextmanager
+    async def slot(self, kind, priority, owner=None, memory=0):
+        await self.acquire(kind, priority, owner, memory)
+        try:
+            yield
+        finally:
+            self.release(kind)
+
+    async def acquire(self, kind, priority, owner=None, memory=0):
+        while True:
+            await self.wait_for_slot(kind, priority, owner)
+            if self.has_memory(memory):
+                return
+            self.release(kind)
+            if not any(self.running.values()):
+                raise Exception('Not enough memory available')
+            # wait for another job to free memory, then queue again
+            Logs.debug(f'Deferring {kind} job, not enough memory available')
+            self.released.clear()
+            await self.released.wait()
+
+    async def wait_for_slot(self, kind, priority, owner):
+        if self.running[kind] < self.limits[kind] and not self.waiting[kind]:
+            self.running[kind] += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self.order), future, owner]
+        heapq.heappush(self.waiting[kind], entry)
+        self.notify()
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # the slot was handed over as this job got canceled
+                self.release(kind)
+            elif entry in self.waiting[kind]:
+                self.waiting[kind].remove(entry)
+                heapq.heapify(self.waiting[kind])
+                self.notify()
+            raise
+
+    def release(self, kind):
+        queue = self.waiting[kind]
+        started = None
+        while queue:
+            _, _, future, owner = heapq.heappop(queue)
+            if not future.done():
+                # the slot passes straight to the next job, running stays the same
+                future.set_result(None)
+                started = owner
+                break
+        else:
+            self.running[kind] -= 1
+        self.released.set()
+        self.notify(started)
+
+    @staticmethod
+    def has_memory(memory):
+        available = available_memory()
+        return not memory or available is None or available - memory >= MIN_FREE_MEMORY
+
+    def position(self, owner):
+        """Returns the 1-based queue position of an owner's first waiting job, 0 if none waits"""
+        positions = []
+        for queue in self.waiting.values():
+            for i, entry in enumerate(sorted(queue)):
+                if entry[3] is owner:
+                    positions.append(i + 1)
+                    break
+        return min(positions, default=0)
+
+    def cancel(self, owner):
+        for kind, queue in self.waiting.items():
+            for entry in [e for e in queue if e[3] is owner]:
+                queue.remove(entry)
+                if not entry[2].done():
+                    entry[2].set_exception(Exception('Canceled'))
+            heapq.heapify(queue)
+        self.notify()
+
+    def notify(self, *extra_owners):
+        """Tells waiting owners, and owners whose job just started, that the queue changed"""
+        owners = {id(e[3]): e[3] for queue in self.waiting.values() for e in queue}
+        owners.update((id(owner), owner) for owner in extra_owners)
+        owners.pop(id(None), None)
+        for owner in owners.values():
+            owner.on_queue_changed()
+
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,54 @@
+import asyncio
+import subprocess
+
+TIMEOUT_CODE = -9
+# the executable is missing or not executable
+START_FAILED_CODE = -1
+
+
+class LocalProcess:
+    """Runs an executable with asyncio, for surfaces computed without a plugin connection
+
+    Mirrors the parts of nanome.util.Process used by SurfaceInstance, which needs
+    a connected plugin instance to start processes.
+    """
+
+    def __init__(self, executable_path=None, args=None, output_text=True, label='', timeout=0, **kwargs):
+        self.executable_path = executable_path
+        self.args = list(args or [])
+        self.output_text = output_text
+        self.label = label
+        # 0 disables the timeout, as for nanome processes
+        self.timeout = timeout
+        self.on_output = lambda _: None
+        self.on_error = lambda _: None
+        self.process: asyncio.subprocess.Process = None
+
+    async def start(self):
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.executable_path, *self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.on_error(f'Failed to start {self.executable_path}: {e}')
+            return START_FAILED_CODE
+        try:
+            stdout, stderr = await asyncio.wait_for(self.process.communicate(), self.timeout or None)
+        except asyncio.TimeoutError:
+            self.stop()
+            return TIMEOUT_CODE
+        except BaseException:
+            self.stop()
+            raise
+
+        if stdout:
+            self.on_output(stdout.decode(errors='replace') if self.output_text else stdout)
+        if stderr:
+            self.on_error(stderr.decode(errors='replace') if self.output_text else stderr)
+        return self.process.returncode
+
+    def stop(self):
+        if self.process and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from nanome.util import Logs
+
+# e.g. /dev/shm to keep MSMS and AOEmbree files in RAM, defaults to the system temp directory
+SCRATCH_ROOT = os.environ.get('SURFACE_SCRATCH_DIR') or None
+SCRATCH_JOB_QUOTA = 4 * 1024 ** 3
+SCRATCH_TOTAL_QUOTA = 16 * 1024 ** 3
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def pending_bytes(step):
+    reserved, written = step
+    return max(reserved - written, 0)
+
+
+class ScratchWorkspace:
+    """Scratch directory of one surface job, with disk quotas and I/O accounting
+
+    Each step gets its own subdirectory through step(), which is removed when
+    the step ends, fails or is canceled. cleanup() removes everything left.
+    A step holds its reserved bytes until it ends, so concurrent steps can't
+    overrun the quotas before any of them has written its files.
+    """
+    # bytes on disk for all workspaces of this plugin process
+    total_used = 0
+    # reserved bytes of active steps not written yet, the rest is already gone from the free space
+    total_pending = 0
+
+    def __init__(self, root=SCRATCH_ROOT, job_quota=SCRATCH_JOB_QUOTA, total_quota=SCRATCH_TOTAL_QUOTA):
+        self.root = root
+        self.job_quota = job_quota
+        self.total_quota = total_quota
+        self.path: str = None
+        self.used = 0
+        # [reserved, written] bytes per active step directory
+        self.steps: dict[str, list[int]] = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def reserve(self, num_bytes):
+        """Counts num_bytes as used, raises ScratchQuotaExceeded if they would exceed a quota or the free space"""
+        if self.used + num_bytes > self.job_quota:
+            raise ScratchQuotaExceeded(f'Surface job would use over {self.job_quota >> 20} MB of scratch space')
+        if ScratchWorkspace.total_used + num_bytes > self.total_quota:
+            raise ScratchQuotaExceeded(f'Surface jobs would use over {self.total_quota >> 20} MB of scratch space')
+        if shutil.disk_usage(self.get_path()).free < ScratchWorkspace.total_pending + num_bytes:
+            raise ScratchQuotaExceeded(f'Not enough free space in {self.path}')
+        self.used += num_bytes
+        ScratchWorkspace.total_used += num_bytes
+
+    def get_path(self):
+        if self.path is None:
+            if self.root:
+                os.makedirs(self.root, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix='surface-', dir=self.root)
+        return self.path
+
+    @contextmanager
+    def step(self, reserve=0):
+        """Reserves the estimated size of a step and yields its directory"""
+        self.reserve(reserve)
+        path = tempfile.mkdtemp(dir=self.get_path())
+        self.steps[path] = [reserve, 0]
+        ScratchWorkspace.total_pending += reserve
+        try:
+            yield path
+        finally:
+            step = self.steps.pop(path)
+            ScratchWorkspace.total_pending -= pending_bytes(step)
+            self.release(max(step))
+            shutil.rmtree(path, ignore_errors=True)
+
+    def written(self, *paths):
+        """Accounts for files written to the workspace, by the plugin or a subprocess
+
+        Files of a step are covered by its reservation, only bytes beyond it are added.
+        """
+        for p in paths:
+            if not os.path.isfile(p):
+                continue
+            size = os.path.getsize(p)
+            self.bytes_written += size
+            step = self.steps.get(os.path.dirname(p))
+            if step is not None:
+                charged = max(step)
+                pending = pending_bytes(step)
+                step[1] += size
+                ScratchWorkspace.total_pending -= pending - pending_bytes(step)
+                size = max(step) - charged
+            self.used += size
+            ScratchWorkspace.total_used += size
+
+    def read(self, *paths):
+        self.bytes_read += sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+    def release(self, num_bytes):
+        num_bytes = min(num_bytes, self.used)
+        self.used -= num_bytes
+        ScratchWorkspace.total_used -= num_bytes
+
+    def cleanup(self):
+        if self.path is None:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        if os.path.exists(self.path):
+            Logs.warning(f'Failed to remove scratch directory {self.path}')
+        self.path = None
+        self.release(self.used)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from nanome.util import Logs
+
+from .utils import evict_files, remove_file, run_in_worker
+
+CACHE_DIR = os.environ.get('SURFACE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'high-quality-surfaces-cache'))
+CACHE_MEMORY_SIZE = 512 * 1024 ** 2
+CACHE_DISK_SIZE = 4 * 1024 ** 3
+
+CACHE_ARRAYS = ['vertices', 'normals', 'triangles', 'indices', 'ao']
+
+
+def hash_surface_input(xyzr: np.ndarray, *params):
+    """Returns a content hash of an xyzr array and the parameters used to surface it"""
+    h = hashlib.sha1()
+    # round to the precision written to the xyzr file, so equal inputs hash equal
+    h.update(np.round(np.asarray(xyzr, dtype=np.float64), 5).tobytes())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+class SurfaceCache:
+    """Two tier LRU cache of computed surfaces, in memory and on disk
+
+    The disk tier is shared by every plugin process pointing to the same directory.
+    Entries are dicts of numpy arrays keyed by hash_surface_input.
+    The memory tier is only used on the event loop, disk reads and writes run in worker threads.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_size=CACHE_MEMORY_SIZE, disk_size=CACHE_DISK_SIZE):
+        self.cache_dir = cache_dir
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory: 'OrderedDict[str, dict[str, np.ndarray]]' = OrderedDict()
+        self.memory_used = 0
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(a.nbytes for a in entry.values())
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry
+
+        entry = await run_in_worker(self.read_disk, key)
+        if entry is not None:
+            self.put_memory(key, entry)
+        return entry
+
+    async def put(self, key, entry: 'dict[str, np.ndarray]'):
+        await self.put_many({key: entry})
+
+    async def put_many(self, entries: 'dict[str, dict[str, np.ndarray]]'):
+        for key, entry in entries.items():
+            self.put_memory(key, entry)
+        await run_in_worker(self.write_disk_many, entries)
+
+    def write_disk_many(self, entries):
+        # evict once for the batch, per-residue surfaces can have a thousand fragments
+        for key, entry in entries.items():
+            self.write_disk(key, entry)
+        self.evict_disk()
+
+    def put_memory(self, key, entry):
+        size = self.entry_size(entry)
+        if size > self.memory_size:
+            return
+        if key in self.memory:
+            self.memory_used -= self.entry_size(self.memory.pop(key))
+        self.memory[key] = entry
+        self.memory_used += size
+        while self.memory_used > self.memory_size:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= self.entry_size(evicted)
+
+    def read_disk(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in CACHE_ARRAYS}
+            # mtime marks last use for eviction
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            Logs.warning(f'Discarding unreadable surface cache entry {key}: {e}')
+            remove_file(path)
+            return None
+
+    def write_disk(self, key, entry):
+        if self.disk_size <= 0:
+            return
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **entry)
+            # atomic, other plugin processes never see partial files
+            os.replace(temp_path, self.path(key))
+        except OSError as e:
+            Logs.warning(f'Failed to write surface cache entry {key}: {e}')
+            if temp_path:
+                remove_file(temp_path)
+
+    def evict_disk(self):
+        evict_files(self.cache_dir, '.npz', self.disk_size)
+
+
+surface_cache = SurfaceCache()
@@ -1,14 +1,30 @@
+import asyncio
 import json
 import os
-import tempfile
 import sys
+from contextlib import contextmanager
 from random import randint
 
+import numpy as np
+
 import nanome
 from nanome import shapes
 from nanome.util import enums, Color, Logs, Process
 
-from .utils import natural_sorted
+from .aoembree import read_ao_text, write_obj
+from .AtomAttributes import AtomAttributes
+from .decimate import decimate
+from .JobScheduler import JOB_AO, JOB_CPU, JOB_MSMS, PRIORITY_INTERACTIVE, job_scheduler
+from .LocalProcess import LocalProcess
+from .metrics import span
+from .msms import msms_output_names, read_msms_output, write_xyzr
+from .native_ao import compute_native_ao
+from .OfflineMesh import OfflineMesh
+from .partition import BLOCK_SIZE, merge_meshes, partition_blocks, trim_to_box
+from .planner import MAX_SURFACE_VERTICES, estimate_vertices, plan_densities
+from .ScratchWorkspace import ScratchWorkspace
+from .SurfaceCache import CACHE_ARRAYS, hash_surface_input, surface_cache
+from .utils import contiguous_ranges, run_in_worker
 
 BASE_DIR = os.path.join(os.path.dirname(__file__))
 MSMS_PATH = None
@@ -16,10 +32,32 @@ AO_PATH = None
 
 MSMS_PROBE_RADIUS = 1.5
 MSMS_DENSITY = 10.0
+MSMS_PREVIEW_DENSITY = 1.0
 MSMS_HDENSITY_SM = 3.0
 MSMS_HDENSITY_LG = 1.0
 AO_STEPS = 512
 AO_MAX_DIST = 50.0
+NATIVE_AO_SAMPLES = 32
+
+AO_ENGINE_EMBREE = 'embree'
+AO_ENGINE_NATIVE = 'native'
+
+# scratch space reserved before writing process input, input and output included
+# xyzr lines are about 48 bytes, MSMS writes about 145 bytes of .vert and .face lines per vertex
+XYZR_LINE_BYTES = 64
+MSMS_SCRATCH_BYTES_PER_VERTEX = 160
+# OBJ vertex, normal and face lines plus the AO value, about 120 bytes per vertex
+AO_SCRATCH_BYTES_PER_VERTEX = 128
+
+# triangle budgets of the levels of detail, the first one caps the uploaded surface
+LOD_TRIANGLES = [2000000, 500000, 125000]
+
+# surface fragments larger than this in overlapping grid blocks, merged after trimming
+PARTITION_ATOM_COUNT = 100000
+
+# rough memory use of the MSMS and AOEmbree processes, checked by the job scheduler before starting them
+MSMS_BYTES_PER_VERTEX = 400
+AO_BYTES_PER_VERTEX = 400
 
 with open(os.path.join(BASE_DIR, 'assets/colors.json')) as f:
     COLORS = json.load(f)
@@ -59,27 +97,48 @@ class SurfaceInstance:
     def __init__(self, name: str, index: int, atoms: 'list[nanome.structure.Atom]'):
         self.name = name
         self.index = index
-        self.atoms = atoms
-
-        self.active_process: Process = None
+        # index the atoms once, the SDK objects aren't walked after this
+        self.attributes = AtomAttributes(atoms)
+        self.xyzr = self.attributes.xyzr
+
+        self.processes: set[Process] = set()
+        # smaller surfaces get their jobs scheduled first
+        self.priority = self.attributes.count
+        self.queue_position = 0
+        self.workspace = ScratchWorkspace()
         self.done = False
         self.canceled = False
+        self.stage = ''
+        self.on_stage_changed = lambda surface: None
 
         self.color_by: enums.ColorScheme = enums.ColorScheme.Chain
         self.color: Color = Color.from_hex(COLOR_PRESETS[randint(1, 12)][1])
         self.visible = True
-
-        self.vertices: list[float] = []
-        self.normals: list[float] = []
-        self.triangles: list[int] = []
-        self.colors: list[float] = []
-        self.indices: list[int] = []
-        self.ao: list[float] = []
-        self.mesh = shapes.Mesh()
+        self.atom_colors: np.ndarray = None
+        self.atom_colors_key = None
+        # recolor requests made while one runs are merged into one more pass
+        self.recolor_task: asyncio.Task = None
+        self.recolor_requested = False
+        # held while the mesh geometry or colors are updated, so recolors never mix levels of detail
+        self.mesh_lock = asyncio.Lock()
+
+        # per-vertex and per-triangle data, converted to lists only in create_mesh
+        self.vertices = np.zeros((0, 3), dtype=np.float32)
+        self.normals = np.zeros((0, 3), dtype=np.float32)
+        self.triangles = np.zeros((0, 3), dtype=np.int32)
+        self.colors = np.zeros((0, 4), dtype=np.float32)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.ao = np.zeros(0, dtype=np.float32)
+        # arrays per level of detail, most detailed first
+        self.lods: list[dict[str, np.ndarray]] = []
+        self.lod = 0
+        self.mesh = shapes.Mesh() if nanome.PluginInstance._instance else OfflineMesh()
+        # mesh data changed since the last upload, the SDK always sends every channel
+        self.dirty: set[str] = set()
 
     @property
     def num_vertices(self):
-        return len(self.vertices) // 3
+        return len(self.vertices)
 
     @property
     def hex_color(self):
@@ -92,268 +151,531 @@ class SurfaceInstance:
         color.a = self.color.a
         self.color = color
 
-    async def generate(self, by_residue=False, by_chain=False, ao=True):
+    async def generate(self, by_residue=False, by_chain=False, ao=True, ao_engine=None, ao_samples=None, progressive=False):
+        """Computes the surface and uploads it
+
+        ao_engine selects AOEmbree or the in-process native engine, defaulting to AOEmbree where available.
+        ao_samples is the number of rays per vertex, lower is faster and noisier.
+        progressive first uploads a low density preview without AO, then replaces it with the full surface.
+        """
         try:
-            if by_residue:
-                await self.compute_msms_by_residue()
-            elif by_chain:
-                await self.compute_msms_by_chain()
-            else:
-                await self.compute_msms(self.atoms)
-            if ao and AO_PATH:
-                await self.compute_ao()
-            await self.create_mesh()
+            if ao_engine is None or ao_engine == AO_ENGINE_EMBREE and not AO_PATH:
+                ao_engine = AO_ENGINE_EMBREE if AO_PATH else AO_ENGINE_NATIVE
+            if ao_samples is None:
+                ao_samples = AO_STEPS if ao_engine == AO_ENGINE_EMBREE else NATIVE_AO_SAMPLES
+            ao_params = (ao_engine, ao_samples) if ao else None
+
+            fragments = self.get_fragments(by_residue, by_chain)
+
+            key = self.get_cache_key(fragments, ao_params)
+            with self.measure('Checking cache') as record:
+                cached = await surface_cache.get(key)
+                record['hit'] = cached is not None
+                if cached is not None:
+                    self.set_arrays(cached)
+            if cached is None:
+                if progressive:
+                    with self.measure('Computing preview'):
+                        await self.compute_msms_fragments(fragments, [MSMS_PREVIEW_DENSITY] * len(fragments))
+                    with self.measure('Uploading preview'):
+                        await self.create_mesh()
+                    self.clear_arrays()
+
+                with self.measure('Computing surface'):
+                    await self.compute_msms_fragments(fragments, self.plan_densities(fragments))
+                if ao:
+                    with self.measure('Computing ambient occlusion', engine=ao_engine, samples=ao_samples):
+                        if ao_engine == AO_ENGINE_NATIVE:
+                            await self.compute_native_ao(ao_samples)
+                        else:
+                            await self.compute_ao(ao_samples)
+                # don't cache a failed AO run under the AO key
+                if not ao or len(self.ao) > 0:
+                    await surface_cache.put(key, self.get_arrays())
+            with self.measure('Simplifying surface'):
+                await self.build_lods()
+            with self.measure('Uploading surface'):
+                await self.create_mesh()
             self.done = True
+            self.set_stage('')
         except Exception as e:
             self.raise_if_canceled()
             raise e
+        finally:
+            self.workspace.cleanup()
+            if self.workspace.bytes_written:
+                Logs.message(f'{self.name} scratch I/O: {self.workspace.bytes_written} bytes written, {self.workspace.bytes_read} bytes read')
+
+    @contextmanager
+    def measure(self, stage, **fields):
+        """Sets the stage and records a span of it, with the mesh size and scratch bytes written at its end"""
+        self.set_stage(stage)
+        bytes_written = self.workspace.bytes_written
+        with span(stage, surface=self.name, atoms=self.attributes.count, **fields) as record:
+            yield record
+            record.update(
+                vertices=self.num_vertices,
+                triangles=len(self.triangles),
+                temp_bytes=self.workspace.bytes_written - bytes_written)
+
+    def get_cache_key(self, fragments, ao_params):
+        fragment_sizes = tuple(end - start for start, end in fragments)
+        if ao_params:
+            ao_params += (AO_MAX_DIST,)
+        params = (
+            MSMS_PROBE_RADIUS, MSMS_DENSITY, MSMS_HDENSITY_SM, MSMS_HDENSITY_LG, MAX_SURFACE_VERTICES,
+            PARTITION_ATOM_COUNT, BLOCK_SIZE, fragment_sizes, ao_params)
+        return hash_surface_input(self.xyzr, *params)
+
+    def get_arrays(self):
+        return {name: getattr(self, name) for name in CACHE_ARRAYS}
+
+    def set_arrays(self, arrays):
+        for name in CACHE_ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def clear_arrays(self):
+        self.set_arrays({name: getattr(self, name)[:0] for name in CACHE_ARRAYS})
+
+    async def build_lods(self):
+        self.lods = await self.run_in_worker(self.get_lods, self.get_arrays())
+        self.lod = 0
+        self.set_arrays(self.lods[0])
+
+    @staticmethod
+    def get_lods(arrays):
+        lods = []
+        for max_triangles in LOD_TRIANGLES:
+            if lods and len(arrays['triangles']) <= max_triangles:
+                break
+            v, n, i, t, ao = decimate(
+                arrays['vertices'], arrays['normals'], arrays['indices'], arrays['triangles'], arrays['ao'], max_triangles)
+            arrays = dict(vertices=v, normals=n, indices=i, triangles=t, ao=ao)
+            lods.append(arrays)
+        return lods
+
+    def get_lod_triangles(self, lod):
+        return len(self.lods[lod]['triangles']) if self.lods else 0
+
+    async def set_lod(self, lod):
+        lod = min(lod, len(self.lods) - 1)
+        if lod == self.lod or lod < 0:
+            return
+        async with self.mesh_lock:
+            self.lod = lod
+            self.set_arrays(self.lods[lod])
+            await self.update_mesh()
+
+    @property
+    def fingerprint(self):
+        return hash_surface_input(self.xyzr)
+
+    def get_state(self):
+        """Returns the settings saved with the surface, see restore"""
+        return dict(
+            name=self.name, fingerprint=self.fingerprint, atom_count=self.attributes.count, lods=len(self.lods),
+            color_by=self.color_by.name, color=self.color.hex, visible=self.visible)
+
+    def get_saved_arrays(self):
+        lods = self.lods or [self.get_arrays()]
+        return {f'lod{i}.{name}': arrays[name] for i, arrays in enumerate(lods) for name in CACHE_ARRAYS}
+
+    async def restore(self, state, arrays):
+        """Shows a saved surface instead of generating it, the arrays must have been saved for the same atoms"""
+        if state['fingerprint'] != self.fingerprint:
+            raise Exception('Saved surface does not match the atoms')
+        with self.measure('Restoring surface'):
+            self.color_by = enums.ColorScheme[state['color_by']]
+            self.color = Color.from_hex(state['color'])
+            self.visible = state['visible']
+            self.lods = [{name: arrays[f'lod{i}.{name}'] for name in CACHE_ARRAYS} for i in range(state['lods'] or 1)]
+            self.lod = 0
+            self.set_arrays(self.lods[0])
+            await self.create_mesh()
+        self.done = True
+        self.set_stage('')
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.on_stage_changed(self)
 
     def destroy(self):
         self.canceled = True
-        if self.active_process:
-            self.active_process.stop()
+        self.recolor_requested = False
+        job_scheduler.cancel(self)
+        self.stop_processes()
+        self.workspace.cleanup()
         self.mesh.destroy()
 
-    def raise_if_canceled(self):
-        if self.canceled:
-            raise Exception('Canceled')
+    def stop_processes(self):
+        for p in list(self.processes):
+            p.stop()
+        self.processes.clear()
 
-    async def compute_msms_by_residue(self):
-        atoms_by_residue = []
-        current_residue = None
-        for atom in self.atoms:
-            if atom.residue.serial != current_residue:
-                current_residue = atom.residue.serial
-                atoms_by_residue.append([])
-            atoms_by_residue[-1].append(atom)
-
-        num_atoms = 0
-        for atoms in atoms_by_residue:
-            await self.compute_msms(atoms, num_atoms)
-            num_atoms += len(atoms)
-
-    async def compute_msms_by_chain(self):
-        atoms_by_chain = []
-        current_chain = None
-        for atom in self.atoms:
-            if atom.chain.name != current_chain:
-                current_chain = atom.chain.name
-                atoms_by_chain.append([])
-            atoms_by_chain[-1].append(atom)
-
-        num_atoms = 0
-        for atoms in atoms_by_chain:
-            await self.compute_msms(atoms, num_atoms)
-            num_atoms += len(atoms)
-
-    async def compute_msms(self, atoms: 'list[nanome.structure.Atom]', index_offset=0):
-        self.raise_if_canceled()
-        temp_dir = tempfile.TemporaryDirectory()
-        msms_input = tempfile.NamedTemporaryFile(dir=temp_dir.name, suffix='.xyzr', delete=False)
-        msms_output = tempfile.NamedTemporaryFile(dir=temp_dir.name, suffix='.out', delete=False)
-        hdensity = MSMS_HDENSITY_SM if len(atoms) < 20000 else MSMS_HDENSITY_LG
-
-        with open(msms_input.name, 'w') as f:
-            for atom in atoms:
-                x, y, z = atom.position
-                # replace unknown atoms with carbon
-                r = 1.7 if atom.vdw_radius < 0.0001 else atom.vdw_radius
-                f.write(f'{x:.5f} {y:.5f} {z:.5f} {r:.5f}\n')
-
-        p = Process(MSMS_PATH, label=f'MSMS {len(atoms)} atoms', output_text=True, timeout=0)
+    @staticmethod
+    def create_process(path, label):
+        # nanome processes need a connected plugin, run them directly in benchmarks and batch runs
+        process_class = Process if nanome.PluginInstance._instance else LocalProcess
+        p = process_class(path, label=label, output_text=True, timeout=0)
         p.on_error = Logs.warning
-        p.args = [
-            '-if ', msms_input.name,
-            '-of ', msms_output.name,
-            '-probe_radius', str(MSMS_PROBE_RADIUS),
-            '-density', str(MSMS_DENSITY),
-            '-hdensity', str(hdensity),
-            '-no_area', '-no_header',
-            '-all_components'
-        ]
+        return p
 
+    async def run_process(self, p: Process):
         self.raise_if_canceled()
-        self.active_process = p
-        exit_code = await p.start()
-        self.active_process = None
+        self.processes.add(p)
+        try:
+            exit_code = await p.start()
+        finally:
+            self.processes.discard(p)
         self.raise_if_canceled()
+        return exit_code
 
-        if exit_code != 0 or not os.path.isfile(msms_output.name + '.vert'):
-            raise Exception('Failed to run MSMS')
+    async def run_in_worker(self, func, *args, priority=None):
+        async with job_scheduler.slot(JOB_CPU, self.priority if priority is None else priority, self):
+            return await run_in_worker(func, *args)
 
-        file_index = 0
-        while True:
-            name = msms_output.name
-            if file_index > 0:
-                name += f'_{file_index}'
-            if not os.path.isfile(name + '.vert'):
-                break
-            vertex_offset = self.num_vertices
-            with open(name + '.vert', 'r') as f:
-                for l in f.readlines():
-                    if l.startswith('#'):
-                        continue
-                    s = l.split()
-                    self.vertices += map(float, s[0:3])
-                    self.normals += map(float, s[3:6])
-                    self.indices.append(int(s[7]) - 1 + index_offset)
-            with open(name + '.face', 'r') as f:
-                for l in f.readlines():
-                    if l.startswith('#'):
-                        continue
-                    s = l.split()
-                    self.triangles += [int(x) - 1 + vertex_offset for x in s[0:3]]
-            file_index += 1
-
-    async def compute_ao(self):
-        self.raise_if_canceled()
-        temp_dir = tempfile.TemporaryDirectory()
-        ao_input = tempfile.NamedTemporaryFile(dir=temp_dir.name, suffix='.obj', delete=False)
-        ao_output = tempfile.NamedTemporaryFile(dir=temp_dir.name, suffix='.out', delete=False)
-
-        with open(ao_input.name, 'w') as f:
-            for v in range(self.num_vertices):
-                i = v * 3
-                f.write(f'v {self.vertices[i]:.6f} {self.vertices[i + 1]:.6f} {self.vertices[i + 2]:.6f}\n')
-                f.write(f'vn {self.normals[i]:.6f} {self.normals[i + 1]:.6f} {self.normals[i + 2]:.6f}\n')
-            for t in range(len(self.triangles) // 3):
-                i = t * 3
-                f.write(f'f {self.triangles[i] + 1} {self.triangles[i + 1] + 1} {self.triangles[i + 2] + 1}\n')
-
-        p = Process(AO_PATH, label=f'AOEmbree {self.num_vertices} vertices', output_text=True, timeout=0)
-        p.on_error = Logs.warning
-        p.args = [
-            '-a', '-n',
-            '-i', ao_input.name,
-            '-o', ao_output.name,
-            '-s', str(AO_STEPS),
-            '-d', str(AO_MAX_DIST)
-        ]
+    def on_queue_changed(self):
+        position = job_scheduler.position(self)
+        if position != self.queue_position:
+            self.queue_position = position
+            self.on_stage_changed(self)
 
+    def raise_if_canceled(self):
+        if self.canceled:
+            raise Exception('Canceled')
+
+    def get_fragments(self, by_residue=False, by_chain=False):
+        if by_residue:
+            return contiguous_ranges(self.attributes.residue_serial)
+        elif by_chain:
+            return contiguous_ranges(self.attributes.chain)
+        return [(0, self.attributes.count)]
+
+    @staticmethod
+    def plan_densities(fragments: 'list[tuple[int, int]]'):
+        return plan_densities([end - start for start, end in fragments], MSMS_DENSITY)
+
+    async def compute_msms_fragments(self, fragments: 'list[tuple[int, int]]', densities: 'list[float]'):
+        # a single fragment is already covered by the whole surface cache entry
+        use_cache = len(fragments) > 1
+        computed = {}
+
+        async def run(start, end, density):
+            xyzr = self.xyzr[start:end]
+            partitioned = len(xyzr) > PARTITION_ATOM_COUNT
+            key = hash_surface_input(xyzr, *self.get_msms_params(len(xyzr), density), partitioned and BLOCK_SIZE)
+            cached = await surface_cache.get(key) if use_cache else None
+            if cached is not None:
+                return cached['vertices'], cached['normals'], cached['indices'], cached['triangles']
+            if partitioned:
+                result = await self.run_msms_partitioned(xyzr, density)
+            else:
+                result = await self.run_msms(xyzr, density)
+            computed[key] = result
+            return result
+
+        tasks = [asyncio.ensure_future(run(start, end, density)) for (start, end), density in zip(fragments, densities)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            self.stop_processes()
+            raise
+
+        if use_cache and computed:
+            no_ao = np.zeros(0, dtype=np.float32)
+            await surface_cache.put_many({
+                key: dict(vertices=v, normals=n, indices=i, triangles=t, ao=no_ao)
+                for key, (v, n, i, t) in computed.items()
+            })
+
+        # stitch in selection order, independent of which run finished first
+        index_offsets = [start for start, _ in fragments]
+        await self.append_fragments(results, index_offsets)
+
+    async def append_fragments(self, fragments, index_offsets):
+        current = (self.vertices, self.normals, self.indices, self.triangles)
+        merged = await self.run_in_worker(merge_meshes, [current, *fragments], [0, *index_offsets])
+        self.vertices, self.normals, self.indices, self.triangles = merged
+
+    async def run_msms_partitioned(self, xyzr: np.ndarray, density):
+        """Surfaces atoms in grid blocks and merges the pieces
+
+        Blocks include the atoms within reach of a probe touching their core box,
+        so each block's surface is exact inside the core, where it is trimmed to.
+        """
+        margin = 2 * MSMS_PROBE_RADIUS + xyzr[:, 3].max()
+        _, _, hdensity = self.get_msms_params(len(xyzr), density)
+
+        async def run(atom_indices, core_min, core_max):
+            v, n, i, t = await self.run_msms(xyzr[atom_indices], density, hdensity)
+            v, n, i, t = await self.run_in_worker(trim_to_box, v, n, i, t, core_min, core_max)
+            return v, n, atom_indices[i], t
+
+        blocks = partition_blocks(xyzr, BLOCK_SIZE, margin)
+        tasks = [asyncio.ensure_future(run(*block)) for block in blocks]
+        try:
+            parts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return await self.run_in_worker(merge_meshes, parts, [0] * len(parts))
+
+    @staticmethod
+    def get_msms_params(num_atoms, density=MSMS_DENSITY):
+        hdensity = MSMS_HDENSITY_SM if num_atoms < 20000 else MSMS_HDENSITY_LG
+        return MSMS_PROBE_RADIUS, density, hdensity
+
+    async def run_msms(self, xyzr: np.ndarray, density=MSMS_DENSITY, hdensity=None):
         self.raise_if_canceled()
-        self.active_process = p
-        exit_code = await p.start()
-        self.active_process = None
+        probe_radius, density, default_hdensity = self.get_msms_params(len(xyzr), density)
+        hdensity = hdensity or default_hdensity
+
+        num_vertices = estimate_vertices([len(xyzr)], [density])
+        scratch_bytes = len(xyzr) * XYZR_LINE_BYTES + num_vertices * MSMS_SCRATCH_BYTES_PER_VERTEX
+        # removed on return, error and cancel
+        with self.workspace.step(scratch_bytes) as temp_dir:
+            msms_input = os.path.join(temp_dir, 'input.xyzr')
+            msms_output = os.path.join(temp_dir, 'output')
+            await self.run_in_worker(write_xyzr, msms_input, xyzr)
+            self.workspace.written(msms_input)
+
+            p = self.create_process(MSMS_PATH, f'MSMS {len(xyzr)} atoms')
+            p.args = [
+                '-if ', msms_input,
+                '-of ', msms_output,
+                '-probe_radius', str(probe_radius),
+                '-density', str(density),
+                '-hdensity', str(hdensity),
+                '-no_area', '-no_header',
+                '-all_components'
+            ]
+
+            memory = num_vertices * MSMS_BYTES_PER_VERTEX
+            async with job_scheduler.slot(JOB_MSMS, self.priority, self, memory):
+                exit_code = await self.run_process(p)
+            output_files = [name + ext for name in msms_output_names(msms_output) for ext in ('.vert', '.face')]
+            self.workspace.written(*output_files)
+            if exit_code != 0 or not os.path.isfile(msms_output + '.vert'):
+                raise Exception('Failed to run MSMS')
+
+            result = await self.run_in_worker(read_msms_output, msms_output)
+            self.workspace.read(*output_files)
+            return result
+
+    async def compute_ao(self, samples=AO_STEPS):
         self.raise_if_canceled()
 
-        if exit_code != 0 or not os.path.isfile(ao_output.name):
-            Logs.warning('Failed to run AOEmbree')
+        # removed on return, error and cancel
+        with self.workspace.step(self.num_vertices * AO_SCRATCH_BYTES_PER_VERTEX) as temp_dir:
+            ao_input = os.path.join(temp_dir, 'input.obj')
+            ao_output = os.path.join(temp_dir, 'output.ao')
+            await self.run_in_worker(write_obj, ao_input, self.vertices, self.normals, self.triangles)
+            self.workspace.written(ao_input)
+
+            p = self.create_process(AO_PATH, f'AOEmbree {self.num_vertices} vertices')
+            p.args = [
+                '-a', '-n',
+                '-i', ao_input,
+                '-o', ao_output,
+                '-s', str(samples),
+                '-d', str(AO_MAX_DIST)
+            ]
+
+            memory = self.num_vertices * AO_BYTES_PER_VERTEX
+            async with job_scheduler.slot(JOB_AO, self.priority, self, memory):
+                exit_code = await self.run_process(p)
+            self.workspace.written(ao_output)
+            if exit_code != 0 or not os.path.isfile(ao_output):
+                Logs.warning('Failed to run AOEmbree')
+                return
+
+            ao = await self.run_in_worker(read_ao_text, ao_output)
+            self.workspace.read(ao_output)
+
+        if len(ao) != self.num_vertices:
+            Logs.warning(f'AOEmbree output has wrong number of vertices, expected {self.num_vertices}, got {len(ao)}')
             return
+        self.ao = ao
 
-        with open(ao_output.name, 'r') as f:
-            data = ' '.join(f.readlines()).split()
-            if len(data) != self.num_vertices:
-                Logs.warning(f'AOEmbree output has wrong number of vertices, expected {self.num_vertices}, got {len(data)}')
-                return
-            self.ao = list(map(float, data))
+    async def compute_native_ao(self, samples=NATIVE_AO_SAMPLES):
+        self.raise_if_canceled()
+        self.ao = await self.run_in_worker(compute_native_ao, self.vertices, self.normals, self.xyzr, samples, AO_MAX_DIST)
+        self.raise_if_canceled()
 
     async def create_mesh(self):
+        async with self.mesh_lock:
+            await self.update_mesh()
+
+    async def update_mesh(self):
+        # callers hold mesh_lock
         self.raise_if_canceled()
         anchor: shapes.Anchor = self.mesh.anchors[0]
         anchor.anchor_type = enums.ShapeAnchorType.Complex
         anchor.target = self.index
 
-        self.mesh.vertices = self.vertices
-        self.mesh.normals = self.normals
-        self.mesh.triangles = self.triangles
+        # the SDK serializes plain lists, so convert at the boundary
+        vertices, normals, triangles = await self.run_in_worker(self.to_lists, self.vertices, self.normals, self.triangles)
+        self.raise_if_canceled()
+        self.mesh.vertices = vertices
+        self.mesh.normals = normals
+        self.mesh.triangles = triangles
         self.mesh.colors = [1, 1, 1, 1] * self.num_vertices
         self.mesh.color = Color.White()
+        self.mesh.color.a = self.color.a if self.visible else 0
         self.mesh.unlit = len(self.ao) > 0
-        await self.apply_color()
+        self.dirty.update(('geometry', 'colors', 'alpha'))
+        await self.update_colors()
+
+    @staticmethod
+    def to_lists(*arrays: np.ndarray):
+        return tuple(array.ravel().tolist() for array in arrays)
 
     def toggle_visible(self, show=None):
         if show == self.visible:
             return
         self.visible = not self.visible if show is None else show
         self.mesh.color.a = self.color.a if self.visible else 0
-        self.mesh.upload()
+        self.dirty.add('alpha')
+        if self.visible and 'colors' in self.dirty:
+            # recolors made while hidden were deferred, apply them with this upload
+            return self.request_recolor()
+        return self.upload()
+
+    def upload(self):
+        """Uploads the mesh if anything changed since the last upload"""
+        if not self.dirty or self.canceled:
+            return
+        self.dirty.clear()
+        return self.mesh.upload()
+
+    @property
+    def recoloring(self):
+        return self.recolor_task is not None and not self.recolor_task.done()
+
+    def request_recolor(self):
+        """Schedules apply_color with the latest color settings
+
+        Requests made while a recolor runs are merged into a single pass after it, so
+        intermediate settings are skipped and the last request always wins.
+        Returns the task applying the colors, shared by all merged requests.
+        """
+        self.recolor_requested = True
+        if not self.recoloring:
+            self.recolor_task = asyncio.ensure_future(self.run_recolors())
+        return self.recolor_task
+
+    async def run_recolors(self):
+        while self.recolor_requested and not self.canceled:
+            self.recolor_requested = False
+            await self.apply_color()
 
     async def apply_color(self):
+        async with self.mesh_lock:
+            await self.update_colors()
+
+    async def update_colors(self):
+        # callers hold mesh_lock
+        custom_color = self.color.rgb if self.color_by in COLOR_BY_CAN_USE_CUSTOM else None
+        key = (self.color_by, custom_color)
+        with span('Applying color', surface=self.name, atoms=self.attributes.count, color_by=self.color_by.name) as record:
+            if key != self.atom_colors_key:
+                self.atom_colors = await self.run_in_worker(self.get_atom_colors, priority=PRIORITY_INTERACTIVE)
+                self.atom_colors_key = key
+                self.dirty.add('colors')
+                if self.recolor_requested:
+                    # a newer recolor is waiting for the lock, it uploads the changes instead
+                    return
+
+            if self.visible and self.mesh.color.a != self.color.a:
+                self.mesh.color.a = self.color.a
+                self.dirty.add('alpha')
+            record['uploaded'] = bool(self.dirty) and self.visible
+            await self.apply_color_to_mesh()
+            record.update(vertices=self.num_vertices, triangles=len(self.triangles))
+
+    def get_atom_colors(self):
+        """Returns an (atoms, 4) RGBA table for the current color scheme"""
         if self.color_by == enums.ColorScheme.Monochrome:
-            r, g, b = (c / 255 for c in self.color.rgb)
-            self.colors = [r, g, b, 1] * self.num_vertices
+            return np.tile(self.rgba, (self.attributes.count, 1))
         elif self.color_by == enums.ColorScheme.Chain:
-            self.apply_color_by_chain()
+            return self.get_colors_by_chain()
         elif self.color_by == enums.ColorScheme.Residue:
-            self.apply_color_by_residue()
+            return self.get_colors_by_residue()
         elif self.color_by == enums.ColorScheme.Element:
-            self.apply_color_by_element()
+            return self.get_colors_by_element()
         elif self.color_by == enums.ColorScheme.Hydrophobicity:
-            self.apply_color_by_hydrophobicity()
+            return self.get_colors_by_hydrophobicity()
         elif self.color_by == enums.ColorScheme.SecondaryStructure:
-            self.apply_color_by_secondary_structure()
-
-        self.mesh.color.a = self.color.a
-        await self.apply_color_to_mesh()
-
-    def apply_color_by_chain(self):
-        chain_names = natural_sorted(set(atom.chain.name for atom in self.atoms))
-        color_per_atom = []
-        for atom in self.atoms:
-            i = chain_names.index(atom.chain.name)
-            t = i / len(chain_names)
-            r, g, b = (c / 255 for c in self.color.rgb)
-            r, g, b = (c + (1 - c) * t for c in (r, g, b))
-            color_per_atom.append([r, g, b, 1])
-        self.apply_color_per_atom(color_per_atom)
-
-    def apply_color_by_residue(self):
-        color_per_atom = []
-        for atom in self.atoms:
-            hex = COLOR_BY_RESIDUE.get(atom.residue.name.upper(), '#808080')
-            r, g, b = (c / 255 for c in Color.from_hex(hex).rgb)
-            color_per_atom.append([r, g, b, 1])
-        self.apply_color_per_atom(color_per_atom)
-
-    def apply_color_by_element(self):
-        color_per_atom = []
-        for atom in self.atoms:
-            hex = COLOR_BY_ELEMENT.get(atom.symbol.lower(), '#ff00ff')
-            r, g, b = (c / 255 for c in Color.from_hex(hex).rgb)
-            color_per_atom.append([r, g, b, 1])
-        self.apply_color_per_atom(color_per_atom)
-
-    def apply_color_by_hydrophobicity(self):
+            return self.get_colors_by_secondary_structure()
+        return np.ones((self.attributes.count, 4), dtype=np.float32)
+
+    @property
+    def rgba(self):
+        return np.array([*(c / 255 for c in self.color.rgb), 1], dtype=np.float32)
+
+    def tint(self, t):
+        # blend from the surface color (t = 0) to white (t = 1)
+        rgba = self.rgba
+        t = np.asarray(t, dtype=np.float32)[:, None]
+        return rgba + (1 - rgba) * t
+
+    @staticmethod
+    def hex_to_rgba(hex):
+        return [*(c / 255 for c in Color.from_hex(hex).rgb), 1]
+
+    def get_colors_by_chain(self):
+        num_chains = len(self.attributes.chain_names)
+        table = self.tint(np.arange(num_chains) / num_chains)
+        return table[self.attributes.chain]
+
+    def get_colors_by_residue(self):
+        hexes = [COLOR_BY_RESIDUE.get(name.upper(), '#808080') for name in self.attributes.residue_names]
+        table = np.array([self.hex_to_rgba(hex) for hex in hexes], dtype=np.float32).reshape(-1, 4)
+        return table[self.attributes.residue_name]
+
+    def get_colors_by_element(self):
+        hexes = [COLOR_BY_ELEMENT.get(symbol.lower(), '#ff00ff') for symbol in self.attributes.elements]
+        table = np.array([self.hex_to_rgba(hex) for hex in hexes], dtype=np.float32).reshape(-1, 4)
+        return table[self.attributes.element]
+
+    def get_colors_by_hydrophobicity(self):
         # color by hydrophobicity, most = color, least = white
         min_hp = RESIDUE_HYDROPHOBICITY['min']
         max_hp = RESIDUE_HYDROPHOBICITY['max']
-        color_per_atom = []
-        for atom in self.atoms:
-            hp = RESIDUE_HYDROPHOBICITY.get(atom.residue.name)
-            if hp is None:
-                color_per_atom.append([0.5, 0.5, 0.5, 1])
-                continue
-            t = 1 - (hp - min_hp) / (max_hp - min_hp)
-            r, g, b = (c / 255 for c in self.color.rgb)
-            r, g, b = (c + (1 - c) * t for c in (r, g, b))
-            color_per_atom.append([r, g, b, 1])
-        self.apply_color_per_atom(color_per_atom)
-
-    def apply_color_by_secondary_structure(self):
+        hp = self.attributes.hydrophobicity(RESIDUE_HYDROPHOBICITY)
+        known = ~np.isnan(hp)
+        colors = np.full((self.attributes.count, 4), [0.5, 0.5, 0.5, 1], dtype=np.float32)
+        colors[known] = self.tint(1 - (hp[known] - min_hp) / (max_hp - min_hp))
+        return colors
+
+    def get_colors_by_secondary_structure(self):
         unknown_color = [0.5, 0.5, 0.5, 1.0]
         coil_color = [0.0784, 1.0, 0.0784, 1.0]
         sheet_color = [0.941, 0.941, 0, 1.0]
         helix_color = [1.0, 0.0784, 0.0784, 1.0]
-        colors = [unknown_color, coil_color, sheet_color, helix_color]
-
-        color_per_atom = []
-        for atom in self.atoms:
-            ss = int(atom.residue.secondary_structure)
-            color_per_atom.append(colors[ss])
-        self.apply_color_per_atom(color_per_atom)
-
-    def apply_color_per_atom(self, color_per_atom):
-        self.colors = []
-        for i in self.indices:
-            self.colors += color_per_atom[i]
+        table = np.array([unknown_color, coil_color, sheet_color, helix_color], dtype=np.float32)
+        return table[self.attributes.secondary_structure]
 
     async def apply_color_to_mesh(self):
-        has_ao = len(self.ao) > 0
-        for i in range(self.num_vertices):
-            j = i * 4
-            r, g, b = self.colors[j:j + 3]
-            ao = self.ao[i] if has_ao else 1
-            self.mesh.colors[j:j + 3] = [r * ao, g * ao, b * ao]
-
-        if self.visible and not self.canceled:
-            await self.mesh.upload()
+        # hidden surfaces are recolored when shown again
+        if not self.visible:
+            return
+        if 'colors' in self.dirty:
+            self.colors, self.mesh.colors = await self.run_in_worker(
+                self.get_mesh_colors, self.atom_colors, self.indices, self.ao, priority=PRIORITY_INTERACTIVE)
+            if self.recolor_requested:
+                return
+        upload = self.upload()
+        if upload is not None:
+            await upload
+
+    @staticmethod
+    def get_mesh_colors(atom_colors, indices, ao):
+        """Returns per-vertex colors shaded by AO, as an array and as the flat list sent to the mesh"""
+        colors = np.take(atom_colors, indices, axis=0)
+        if len(ao) > 0:
+            colors[:, 0:3] *= ao[:, None]
+        return colors, colors.ravel().tolist()
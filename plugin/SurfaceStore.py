@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+import numpy as np
+from nanome.util import Logs
+
+from .surface_file import read_surface_file, read_surface_header, update_surface_meta, write_surface_file
+from .utils import evict_files, process_exists, remove_file, run_in_worker
+
+STORE_DIR = os.environ.get('SURFACE_STORE_DIR', os.path.join(tempfile.gettempdir(), 'high-quality-surfaces-store'))
+STORE_DISK_SIZE = 8 * 1024 ** 3
+# compressed files are about half the size, but are read whole instead of memory mapped
+STORE_COMPRESS = os.environ.get('SURFACE_STORE_COMPRESS', '') not in ('', '0')
+STORE_EXTENSION = '.hqs'
+
+
+def get_presenter_dir(account_id, store_dir=STORE_DIR):
+    """Returns the store directory of a presenter, or None to disable the store when the account is unknown"""
+    if not account_id:
+        return None
+    return os.path.join(store_dir, hashlib.sha1(str(account_id).encode()).hexdigest()[:16])
+
+
+class SurfaceStore:
+    """Finished surfaces saved to disk, restored when their entry is seen again after a reconnect
+
+    Files are written when a surface finishes, their metadata is updated when it is
+    recolored or toggled, and they are removed when the surface is deleted.
+    Each presenter has their own directory. A file shown by a running plugin
+    session records its process id, other sessions leave it alone until then.
+    A store without a directory saves and restores nothing.
+    """
+
+    def __init__(self, store_dir=None, disk_size=STORE_DISK_SIZE, compress=STORE_COMPRESS):
+        self.store_dir = store_dir
+        self.disk_size = disk_size
+        self.compress = compress
+        # files of the surfaces shown by this store
+        self.paths: 'dict[object, str]' = {}
+        self.entries: 'dict[object, dict]' = {}
+        # file operations run in workers one at a time, so an update never races a removal or a scan
+        self.lock = asyncio.Lock()
+
+    async def save(self, surface, complex_index, complex_name, atom_ordinals: np.ndarray):
+        """Saves a finished surface, atom_ordinals locate its atoms in the ComplexIndex of the entry"""
+        if self.store_dir is None or self.disk_size <= 0:
+            return
+        path = os.path.join(self.store_dir, uuid.uuid4().hex + STORE_EXTENSION)
+        entry = dict(complex_index=complex_index, complex_name=complex_name, saved=time.time(), owner=os.getpid())
+        arrays = dict(surface.get_saved_arrays(), atoms=np.asarray(atom_ordinals, dtype=np.int32))
+        try:
+            await run_in_worker(os.makedirs, self.store_dir, exist_ok=True)
+            await run_in_worker(write_surface_file, path, dict(entry, **surface.get_state()), arrays, self.compress)
+        except OSError as e:
+            Logs.warning(f'Failed to save surface {surface.name}: {e}')
+            return
+        if surface.canceled:
+            # deleted while saving
+            await self.remove_path(path)
+            return
+        self.paths[surface] = path
+        self.entries[surface] = entry
+        async with self.lock:
+            await run_in_worker(evict_files, self.store_dir, STORE_EXTENSION, self.disk_size, set(self.paths.values()))
+
+    async def update(self, surface):
+        path = self.paths.get(surface)
+        if path is None:
+            return
+        await self.write_meta(surface, path, dict(self.entries[surface], **surface.get_state()))
+
+    async def remove(self, surface):
+        path = self.paths.pop(surface, None)
+        self.entries.pop(surface, None)
+        if path:
+            await self.remove_path(path)
+
+    async def release(self, surface):
+        # the surface is gone but its file is kept, to restore it when the entry is seen again
+        path = self.paths.pop(surface, None)
+        entry = self.entries.pop(surface, None)
+        if path is None:
+            return
+        await self.write_meta(surface, path, dict(entry, owner=None, **surface.get_state()))
+
+    async def find(self, complex_index, complex_name):
+        """Returns (path, meta) of saved surfaces of an entry, matching both its index and name, not shown by any session"""
+        if self.store_dir is None:
+            return []
+        async with self.lock:
+            return await run_in_worker(self.scan, complex_index, complex_name, set(self.paths.values()))
+
+    def scan(self, complex_index, complex_name, in_use):
+        found = []
+        try:
+            paths = [e.path for e in os.scandir(self.store_dir) if e.name.endswith(STORE_EXTENSION)]
+        except OSError:
+            return found
+        for path in paths:
+            if path in in_use:
+                continue
+            try:
+                meta, _, _ = read_surface_header(path)
+            except Exception as e:
+                Logs.warning(f'Discarding unreadable saved surface {path}: {e}')
+                remove_file(path)
+                continue
+            if meta['complex_index'] != complex_index or meta['complex_name'] != complex_name:
+                continue
+            if meta['owner'] is not None and process_exists(meta['owner']):
+                continue
+            found.append((path, meta))
+        return sorted(found, key=lambda item: item[1]['saved'])
+
+    def load(self, path):
+        """Returns (meta, arrays) of a saved surface, memory mapped unless compressed"""
+        meta, arrays = read_surface_file(path)
+        # mtime marks last use for eviction
+        os.utime(path)
+        return meta, arrays
+
+    async def adopt(self, surface, path, meta):
+        """Tracks a restored surface, marking its file as shown by this session"""
+        self.paths[surface] = path
+        self.entries[surface] = dict(
+            complex_index=meta['complex_index'], complex_name=meta['complex_name'], saved=meta['saved'], owner=os.getpid())
+        await self.update(surface)
+
+    async def write_meta(self, surface, path, meta):
+        async with self.lock:
+            try:
+                await run_in_worker(update_surface_meta, path, meta)
+            except Exception as e:
+                Logs.warning(f'Failed to update saved surface {surface.name}: {e}')
+
+    async def remove_path(self, path):
+        async with self.lock:
+            await run_in_worker(remove_file, path)
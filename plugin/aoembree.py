@@ -0,0 +1,13 @@
+import numpy as np
+
+from .utils import write_rows
+
+
+def write_obj(path, vertices, normals, triangles):
+    with open(path, 'w') as f:
+        write_rows(f, 'v %.6f %.6f %.6f\nvn %.6f %.6f %.6f\n', np.hstack((vertices, normals)).astype(np.float64))
+        write_rows(f, 'f %d %d %d\n', triangles.astype(np.int64) + 1)
+
+
+def read_ao_text(path):
+    return np.fromfile(path, dtype=np.float32, sep=' ')
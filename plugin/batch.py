@@ -0,0 +1,209 @@
+"""Headless batch surfacing of structure files
+
+Surfaces each input with the same pipeline and coloring as the plugin, and
+writes the colored meshes to the output directory. Finished inputs are recorded
+in a manifest there, so rerunning an interrupted batch skips them.
+
+    python run.py batch 1abc.pdb 2xyz.cif ligand.sdf --output-dir surfaces --format ply
+    python run.py batch *.xyzr --output-dir surfaces --mode chain --ao native --jobs 4
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+from nanome.api.structure import Complex
+from nanome.util import Logs
+
+from .ComplexIndex import ComplexIndex
+from .export import export_mesh
+from .SurfaceInstance import AO_ENGINE_EMBREE, AO_ENGINE_NATIVE, COLOR_BY_OPTIONS, COLOR_PRESETS, SurfaceInstance
+from .utils import run_in_worker
+
+MANIFEST_NAME = 'manifest.json'
+# bump when the output of the same settings changes
+MANIFEST_VERSION = 1
+
+FORMAT_EXTENSIONS = {'obj': 'obj', 'ply': 'ply', 'gltf': 'glb'}
+COLOR_BY_NAMES = {name.lower().replace(' ', '-'): color_by for name, color_by in COLOR_BY_OPTIONS}
+# fixed instead of the plugin's random preset, so reruns and resumed batches match
+DEFAULT_COLOR = COLOR_PRESETS[1][1]
+STRUCTURE_READERS = {
+    'pdb': Complex.io.from_pdb,
+    'ent': Complex.io.from_pdb,
+    'cif': Complex.io.from_mmcif,
+    'sdf': Complex.io.from_sdf,
+}
+
+
+def load_atoms(path, include_hydrogens, include_waters):
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension == 'xyzr':
+        return load_xyzr_atoms(path)
+    reader = STRUCTURE_READERS.get(extension)
+    if reader is None:
+        raise Exception(f'Unsupported structure format: {extension}')
+    index = ComplexIndex(reader(path=path))
+    return index.get_atoms(index.filter_mask(include_hydrogens, include_waters, False))
+
+
+def load_xyzr_atoms(path):
+    """Returns stand-in atoms for an MSMS xyzr file, which has no chain, residue or element data"""
+    xyzr = np.loadtxt(path, usecols=(0, 1, 2, 3), ndmin=2)
+    chain = SimpleNamespace(name='A')
+    residue = SimpleNamespace(serial=1, name='UNK', secondary_structure=0)
+    return [
+        SimpleNamespace(position=(x, y, z), vdw_radius=r, symbol='C', chain=chain, residue=residue)
+        for x, y, z, r in xyzr.tolist()
+    ]
+
+
+def get_input_key(path, settings):
+    # inputs are redone when the file or the settings change
+    stat = os.stat(path)
+    content = json.dumps([MANIFEST_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime_ns, settings])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get_output_names(paths, extension):
+    names = []
+    used = set()
+    for path in paths:
+        base = os.path.splitext(os.path.basename(path))[0]
+        name = f'{base}.{extension}'
+        suffix = 2
+        while name in used:
+            name = f'{base}-{suffix}.{extension}'
+            suffix += 1
+        used.add(name)
+        names.append(name)
+    return names
+
+
+class Manifest:
+    """Status of each input of a batch, saved after every change"""
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f).get('inputs', {})
+
+    def is_done(self, path, key, output_path):
+        entry = self.entries.get(os.path.abspath(path))
+        return entry is not None and entry['status'] == 'done' and entry['key'] == key and os.path.exists(output_path)
+
+    def set(self, path, **entry):
+        self.entries[os.path.abspath(path)] = entry
+        # write aside and rename, an interrupted batch must leave a readable manifest
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'inputs': self.entries}, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+async def surface_file(path, output_path, args):
+    atoms = await run_in_worker(load_atoms, path, args.include_hydrogens, args.include_waters)
+    if not atoms:
+        raise Exception('No atoms to surface')
+
+    surface = SurfaceInstance(os.path.basename(path), 0, atoms)
+    try:
+        ao = args.ao != 'none'
+        await surface.generate(
+            by_residue=args.mode == 'residue', by_chain=args.mode == 'chain',
+            ao=ao, ao_engine=args.ao if ao else None)
+        surface.color_by = COLOR_BY_NAMES[args.color_by]
+        surface.hex_color = args.color
+        await surface.apply_color()
+
+        # export aside and rename, a partial mesh must never look finished
+        root, extension = os.path.splitext(output_path)
+        temp_path = f'{root}.partial{extension}'
+        await run_in_worker(
+            export_mesh, temp_path,
+            surface.vertices, surface.normals, surface.triangles, surface.colors, surface.ao)
+        os.replace(temp_path, output_path)
+        return surface.num_vertices, len(surface.triangles)
+    finally:
+        surface.destroy()
+
+
+async def run_batch(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.output_dir)
+    settings = dict(
+        format=args.format, mode=args.mode, ao=args.ao, color_by=args.color_by, color=args.color,
+        include_hydrogens=args.include_hydrogens, include_waters=args.include_waters)
+    output_names = get_output_names(args.inputs, FORMAT_EXTENSIONS[args.format])
+    # msms and ao processes are also limited by the job scheduler
+    semaphore = asyncio.Semaphore(args.jobs)
+    failed = []
+
+    async def run_one(path, output_name):
+        output_path = os.path.join(args.output_dir, output_name)
+        key = get_input_key(path, settings)
+        if manifest.is_done(path, key, output_path):
+            Logs.message(f'{path}: already done, skipping')
+            return
+        async with semaphore:
+            manifest.set(path, key=key, status='running', output=output_name)
+            try:
+                num_vertices, num_triangles = await surface_file(path, output_path, args)
+            except Exception as e:
+                Logs.error(f'{path}: failed: {e}')
+                manifest.set(path, key=key, status='failed', output=output_name, error=str(e))
+                failed.append(path)
+                return
+            manifest.set(
+                path, key=key, status='done', output=output_name,
+                vertices=num_vertices, triangles=num_triangles)
+            Logs.message(f'{path}: {num_vertices} vertices written to {output_path}')
+
+    await asyncio.gather(*(run_one(path, name) for path, name in zip(args.inputs, output_names)))
+    return failed
+
+
+def main(argv=None):
+    from . import SurfaceInstance as surface_module
+
+    parser = argparse.ArgumentParser(
+        prog='run.py batch', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='PDB, mmCIF, SDF or xyzr files')
+    parser.add_argument('--output-dir', default='surfaces')
+    parser.add_argument('--format', choices=list(FORMAT_EXTENSIONS), default='ply')
+    parser.add_argument('--mode', choices=['all', 'chain', 'residue'], default='all', help='surface per')
+    parser.add_argument(
+        '--ao', choices=[AO_ENGINE_EMBREE, AO_ENGINE_NATIVE, 'none'],
+        help='defaults to embree when its executable can be run, native otherwise')
+    parser.add_argument('--color-by', choices=list(COLOR_BY_NAMES), default='chain')
+    parser.add_argument(
+        '--color', default=DEFAULT_COLOR, help='hex color for schemes using a custom color, e.g. #ff8000')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='inputs surfaced at once')
+    parser.add_argument('--include-hydrogens', action='store_true')
+    parser.add_argument('--include-waters', action='store_true')
+    parser.add_argument('--msms-path', help='MSMS executable, defaults to the bundled one')
+    parser.add_argument('--ao-path', help='AOEmbree executable, defaults to the bundled one')
+    args = parser.parse_args(argv)
+
+    if args.msms_path:
+        surface_module.MSMS_PATH = args.msms_path
+    if args.ao_path:
+        surface_module.AO_PATH = args.ao_path
+    if args.ao is None:
+        # a plain checkout may lose the executable bit of the bundled binary
+        ao_path = surface_module.AO_PATH
+        args.ao = AO_ENGINE_EMBREE if ao_path and os.access(ao_path, os.X_OK) else AO_ENGINE_NATIVE
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    failed = asyncio.run(run_batch(args))
+    if failed:
+        Logs.error(f'{len(failed)} of {len(args.inputs)} inputs failed')
+        sys.exit(1)
@@ -0,0 +1,63 @@
+import numpy as np
+
+# attempts at growing the cluster size before settling for a mesh over budget
+MAX_PASSES = 8
+# axis-aligned normal directions, so the two sides of thin walls aren't merged
+NORMAL_BINS = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]], dtype=np.float32)
+
+
+def cluster_vertices(vertices, normals, indices, triangles, ao, cell_size):
+    """Merges vertices sharing a grid cell and normal direction, dropping collapsed triangles
+
+    Merged vertices are averaged, and take the atom index of one of their vertices.
+    """
+    cells = np.floor(vertices / cell_size).astype(np.int64)
+    directions = np.argmax(normals @ NORMAL_BINS.T, axis=1)
+    keys = np.column_stack((cells, directions))
+    _, first, cluster = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    cluster = cluster.ravel()
+    num_clusters = len(first)
+
+    counts = np.bincount(cluster, minlength=num_clusters).astype(np.float32)[:, None]
+    new_vertices = np.empty((num_clusters, 3), dtype=np.float32)
+    new_normals = np.empty((num_clusters, 3), dtype=np.float32)
+    for axis in range(3):
+        new_vertices[:, axis] = np.bincount(cluster, vertices[:, axis], num_clusters)
+        new_normals[:, axis] = np.bincount(cluster, normals[:, axis], num_clusters)
+    new_vertices /= counts
+    new_normals /= np.maximum(np.linalg.norm(new_normals, axis=1), 1e-9)[:, None]
+    new_ao = ao
+    if len(ao) > 0:
+        new_ao = (np.bincount(cluster, ao, num_clusters) / counts[:, 0]).astype(np.float32)
+
+    new_triangles = cluster[triangles]
+    a, b, c = new_triangles.T
+    new_triangles = new_triangles[(a != b) & (b != c) & (a != c)]
+    # clusters can end up connected by the same triangle more than once
+    _, unique = np.unique(np.sort(new_triangles, axis=1), axis=0, return_index=True)
+    new_triangles = new_triangles[np.sort(unique)]
+
+    return new_vertices, new_normals, indices[first], new_triangles.astype(np.int32), new_ao
+
+
+def decimate(vertices, normals, indices, triangles, ao, max_triangles):
+    """Simplifies a mesh to at most max_triangles by vertex clustering
+
+    Returns (vertices, normals, indices, triangles, ao), unchanged if already within budget.
+    """
+    if len(triangles) <= max_triangles:
+        return vertices, normals, indices, triangles, ao
+
+    # triangle count falls with the square of the cluster size, start from the mean edge length
+    edges = vertices[triangles[:, 0]] - vertices[triangles[:, 1]]
+    edge_length = float(np.linalg.norm(edges, axis=1).mean())
+    cell_size = edge_length * np.sqrt(len(triangles) / max_triangles)
+
+    result = vertices, normals, indices, triangles, ao
+    for _ in range(MAX_PASSES):
+        result = cluster_vertices(vertices, normals, indices, triangles, ao, cell_size)
+        num_triangles = len(result[3])
+        if num_triangles <= max_triangles:
+            break
+        cell_size *= max(1.1, np.sqrt(num_triangles / max_triangles))
+    return result
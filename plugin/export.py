@@ -0,0 +1,119 @@
+import json
+import struct
+
+import numpy as np
+
+from .utils import write_rows
+
+GLB_MAGIC = 0x46546C67
+GLB_JSON = 0x4E4F534A
+GLB_BIN = 0x004E4942
+GL_FLOAT = 5126
+GL_UNSIGNED_INT = 5125
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+
+
+def export_mesh(path, vertices, normals, triangles, colors, ao):
+    """Writes a colored mesh as OBJ, PLY or binary glTF, picked by the file extension
+
+    colors are per-vertex RGBA in [0, 1] with AO applied, ao is per-vertex and may be empty.
+    OBJ has no field for AO, which is only kept baked into its colors.
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    writer = EXPORT_FORMATS.get(extension)
+    if writer is None:
+        raise Exception(f'Unsupported mesh format: {extension}')
+    writer(path, vertices, normals, triangles, colors, ao)
+
+
+def export_obj(path, vertices, normals, triangles, colors, ao):
+    # vertex colors follow the positions, a widely read OBJ extension
+    with open(path, 'w') as f:
+        write_rows(f, 'v %.4f %.4f %.4f %.4f %.4f %.4f\n', np.hstack((vertices, colors[:, 0:3])).astype(np.float64))
+        write_rows(f, 'vn %.4f %.4f %.4f\n', normals.astype(np.float64))
+        write_rows(f, 'f %d//%d %d//%d %d//%d\n', np.repeat(triangles.astype(np.int64) + 1, 2, axis=1))
+
+
+def export_ply(path, vertices, normals, triangles, colors, ao):
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4'),
+              ('red', 'u1'), ('green', 'u1'), ('blue', 'u1'), ('alpha', 'u1')]
+    has_ao = len(ao) == len(vertices) and len(ao) > 0
+    if has_ao:
+        fields.append(('ao', '<f4'))
+    data = np.empty(len(vertices), dtype=fields)
+    for i, axis in enumerate('xyz'):
+        data[axis] = vertices[:, i]
+        data['n' + axis] = normals[:, i]
+    rgba = np.clip(np.round(colors * 255), 0, 255).astype(np.uint8)
+    for i, channel in enumerate(('red', 'green', 'blue', 'alpha')):
+        data[channel] = rgba[:, i]
+    if has_ao:
+        data['ao'] = ao
+
+    faces = np.empty(len(triangles), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+    faces['count'] = 3
+    faces['indices'] = triangles
+
+    ply_types = {'<f4': 'float', 'u1': 'uchar'}
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(vertices)}']
+    header += [f'property {ply_types[t]} {name}' for name, t in fields]
+    header += [f'element face {len(triangles)}', 'property list uchar int vertex_indices', 'end_header']
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(data.tobytes())
+        f.write(faces.tobytes())
+
+
+def export_glb(path, vertices, normals, triangles, colors, ao):
+    attributes = {
+        'POSITION': np.ascontiguousarray(vertices, dtype='<f4'),
+        'NORMAL': np.ascontiguousarray(normals, dtype='<f4'),
+        'COLOR_0': np.ascontiguousarray(colors, dtype='<f4'),
+    }
+    if len(ao) == len(vertices) and len(ao) > 0:
+        # application specific attributes start with an underscore
+        attributes['_AO'] = np.ascontiguousarray(ao, dtype='<f4')
+    indices = np.ascontiguousarray(triangles, dtype='<u4').ravel()
+
+    types = {1: 'SCALAR', 3: 'VEC3', 4: 'VEC4'}
+    binary = bytearray()
+    views = []
+    accessors = []
+    for name, array in [*attributes.items(), ('indices', indices)]:
+        # views are 4 byte aligned
+        binary.extend(b'\0' * (-len(binary) % 4))
+        target = GL_ELEMENT_ARRAY_BUFFER if name == 'indices' else GL_ARRAY_BUFFER
+        views.append(dict(buffer=0, byteOffset=len(binary), byteLength=array.nbytes, target=target))
+        binary.extend(array.tobytes())
+        width = 1 if array.ndim == 1 else array.shape[1]
+        accessor = dict(
+            bufferView=len(views) - 1, count=len(array), type=types[width],
+            componentType=GL_UNSIGNED_INT if name == 'indices' else GL_FLOAT)
+        if name == 'POSITION':
+            accessor['min'] = array.min(axis=0).tolist() if len(array) else [0, 0, 0]
+            accessor['max'] = array.max(axis=0).tolist() if len(array) else [0, 0, 0]
+        accessors.append(accessor)
+    binary.extend(b'\0' * (-len(binary) % 4))
+
+    primitive = dict(attributes={name: i for i, name in enumerate(attributes)}, indices=len(attributes), mode=4)
+    gltf = dict(
+        asset=dict(version='2.0', generator='High Quality Surfaces'),
+        scene=0, scenes=[dict(nodes=[0])], nodes=[dict(mesh=0)], meshes=[dict(primitives=[primitive])],
+        buffers=[dict(byteLength=len(binary))], bufferViews=views, accessors=accessors)
+    content = json.dumps(gltf, separators=(',', ':')).encode()
+    content += b' ' * (-len(content) % 4)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<III', GLB_MAGIC, 2, 12 + 8 + len(content) + 8 + len(binary)))
+        f.write(struct.pack('<II', len(content), GLB_JSON))
+        f.write(content)
+        f.write(struct.pack('<II', len(binary), GLB_BIN))
+        f.write(binary)
+
+
+EXPORT_FORMATS = {
+    'obj': export_obj,
+    'ply': export_ply,
+    'glb': export_glb,
+}
@@ -0,0 +1,132 @@
+import os
+import re
+import socket
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from nanome.util import Logs
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# optional sinks for stage spans, a node exporter textfile collector path and a host:port StatsD address
+METRICS_TEXTFILE = os.environ.get('SURFACE_METRICS_TEXTFILE')
+STATSD_ADDRESS = os.environ.get('SURFACE_STATSD_ADDRESS')
+STATSD_PREFIX = 'high_quality_surfaces'
+
+# ru_maxrss is in kilobytes on linux and bytes on macos
+RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+# called with each finished span record
+metrics_hooks = []
+
+
+def resource_usage():
+    """Returns (subprocess cpu seconds, peak rss bytes, subprocess peak rss bytes) of the plugin process"""
+    if resource is None:
+        return 0.0, 0, 0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime, own.ru_maxrss * RSS_SCALE, children.ru_maxrss * RSS_SCALE
+
+
+@contextmanager
+def span(stage, **fields):
+    """Measures a stage and emits it as a structured record when it ends
+
+    The yielded record can be filled with output fields such as vertex counts.
+    Subprocess cpu time covers all processes that finished during the span, and
+    peak memory is the high water mark of the plugin process and its children.
+    """
+    record = dict(stage=stage, **fields)
+    cpu_start, _, _ = resource_usage()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = str(e) or type(e).__name__
+        raise
+    finally:
+        cpu_end, peak_rss, subprocess_peak_rss = resource_usage()
+        record.update(
+            duration=time.perf_counter() - start,
+            subprocess_cpu=cpu_end - cpu_start,
+            peak_rss=peak_rss,
+            subprocess_peak_rss=subprocess_peak_rss)
+        emit(record)
+
+
+def emit(record):
+    Logs.message(f"{record.get('surface', '')} {record['stage']}: {record['duration']:.3f}s", extra=record)
+    for hook in metrics_hooks:
+        try:
+            hook(record)
+        except Exception as e:
+            Logs.warning(f'Metrics hook failed: {e}')
+
+
+def metric_name(stage):
+    return re.sub(r'[^a-z0-9]+', '_', stage.lower()).strip('_')
+
+
+class PrometheusTextfile:
+    """Keeps per-stage totals and rewrites them to a node exporter textfile after each span"""
+
+    def __init__(self, path):
+        self.path = path
+        self.seconds = {}
+        self.count = {}
+        self.errors = {}
+
+    def __call__(self, record):
+        stage = metric_name(record['stage'])
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + record['duration']
+        self.count[stage] = self.count.get(stage, 0) + 1
+        self.errors[stage] = self.errors.get(stage, 0) + ('error' in record)
+
+        lines = [
+            '# TYPE surface_stage_seconds_total counter',
+            *(f'surface_stage_seconds_total{{stage="{s}"}} {v:.6f}' for s, v in self.seconds.items()),
+            '# TYPE surface_stage_total counter',
+            *(f'surface_stage_total{{stage="{s}"}} {v}' for s, v in self.count.items()),
+            '# TYPE surface_stage_errors_total counter',
+            *(f'surface_stage_errors_total{{stage="{s}"}} {v}' for s, v in self.errors.items()),
+            '# TYPE surface_peak_rss_bytes gauge',
+            f"surface_peak_rss_bytes {record['peak_rss']}",
+        ]
+        # write aside and rename, the collector must never read a partial file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.path)
+
+
+class StatsD:
+    """Sends span durations and sizes to a StatsD daemon over UDP"""
+
+    def __init__(self, address, prefix=STATSD_PREFIX):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, record):
+        stage = f'{self.prefix}.{metric_name(record["stage"])}'
+        lines = [f"{stage}.duration:{record['duration'] * 1000:.3f}|ms"]
+        for field in ('vertices', 'triangles', 'temp_bytes'):
+            if field in record:
+                lines.append(f'{stage}.{field}:{record[field]}|g')
+        if 'error' in record:
+            lines.append(f'{stage}.errors:1|c')
+        self.socket.sendto('\n'.join(lines).encode(), self.address)
+
+
+if METRICS_TEXTFILE:
+    metrics_hooks.append(PrometheusTextfile(METRICS_TEXTFILE))
+if STATSD_ADDRESS:
+    metrics_hooks.append(StatsD(STATSD_ADDRESS))
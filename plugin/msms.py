@@ -0,0 +1,64 @@
+import os
+import warnings
+
+import numpy as np
+
+from .utils import write_rows
+
+# .vert columns: x y z nx ny nz face_type atom_index sphere_type
+VERT_COLUMNS = (0, 1, 2, 3, 4, 5, 7)
+# .face columns: v1 v2 v3 face_type sphere_index
+FACE_COLUMNS = (0, 1, 2)
+
+def write_xyzr(path, xyzr: np.ndarray):
+    """Writes an (N, 4) array as an MSMS xyzr file"""
+    with open(path, 'w') as f:
+        write_rows(f, '%.5f %.5f %.5f %.5f\n', xyzr)
+
+
+def _load_columns(path, usecols, dtype):
+    # loadtxt parses in C and skips '#' header lines without per-line python work
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)  # empty component files
+        data = np.loadtxt(path, comments='#', usecols=usecols, dtype=dtype, ndmin=2)
+    return data.reshape(-1, len(usecols))
+
+
+def msms_output_names(output_name):
+    """Returns the base names of all MSMS component files (name, name_1, name_2, ...)"""
+    names = []
+    while True:
+        name = output_name if not names else f'{output_name}_{len(names)}'
+        if not os.path.isfile(name + '.vert'):
+            return names
+        names.append(name)
+
+
+def read_msms_output(output_name):
+    """Parses all .vert/.face component files written by MSMS with -all_components
+
+    Returns (vertices, normals, indices, triangles) where indices are 0-based atom indices
+    and triangles reference vertices across all components.
+    """
+    verts = []
+    faces = []
+    for name in msms_output_names(output_name):
+        verts.append(_load_columns(name + '.vert', VERT_COLUMNS, np.float64))
+        faces.append(_load_columns(name + '.face', FACE_COLUMNS, np.int32))
+
+    if not verts:
+        return (
+            np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.float32),
+            np.zeros(0, dtype=np.int32), np.zeros((0, 3), dtype=np.int32))
+
+    # faces are 1-based per component, shift them by the vertices of previous components
+    offsets = np.cumsum([0] + [len(v) for v in verts[:-1]]) - 1
+    for face, offset in zip(faces, offsets):
+        face += offset
+
+    vert = np.concatenate(verts)
+    vertices = vert[:, 0:3].astype(np.float32)
+    normals = vert[:, 3:6].astype(np.float32)
+    indices = vert[:, 6].astype(np.int32) - 1
+    triangles = np.concatenate(faces)
+    return vertices, normals, indices, triangles
@@ -0,0 +1,97 @@
+import numpy as np
+
+# voxel size of the atom occupancy grid, in angstrom
+GRID_SPACING = 1.0
+# rays march in steps growing by this factor, fine near the surface and coarse far away
+STEP_GROWTH = 1.2
+VERTEX_CHUNK_SIZE = 4096
+
+
+def cosine_hemisphere(num_points):
+    """Evenly spread, cosine weighted directions around +z (fibonacci points on the unit disk lifted to the hemisphere)"""
+    i = np.arange(num_points) + 0.5
+    r = np.sqrt(i / num_points)
+    theta = np.pi * (1 + 5 ** 0.5) * i
+    return np.column_stack((r * np.cos(theta), r * np.sin(theta), np.sqrt(1 - r ** 2)))
+
+
+def tangent_frames(normals):
+    """Returns (N, 3, 3) rotations mapping +z onto each normal"""
+    helper = np.zeros_like(normals)
+    use_x = np.abs(normals[:, 0]) < 0.9
+    helper[use_x, 0] = 1
+    helper[~use_x, 1] = 1
+    tangent = np.cross(helper, normals)
+    tangent /= np.linalg.norm(tangent, axis=1)[:, None]
+    bitangent = np.cross(normals, tangent)
+    return np.stack((tangent, bitangent, normals), axis=1)
+
+
+class OccupancyGrid:
+    """Boolean voxel grid marking space inside atom spheres"""
+
+    def __init__(self, xyzr: np.ndarray, spacing=GRID_SPACING):
+        self.spacing = spacing
+        max_r = xyzr[:, 3].max()
+        # one empty cell of padding, lookups outside the grid are clamped onto it
+        self.origin = xyzr[:, 0:3].min(axis=0) - max_r - spacing
+        upper = xyzr[:, 0:3].max(axis=0) + max_r + spacing
+        self.shape = np.ceil((upper - self.origin) / spacing).astype(int) + 1
+        self.grid = np.zeros(self.shape, dtype=bool)
+
+        # stencil of cell offsets covering the largest sphere
+        n = int(np.ceil(max_r / spacing))
+        r = np.arange(-n, n + 1)
+        stencil = np.stack(np.meshgrid(r, r, r, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        chunk_size = max(1, 2 ** 20 // len(stencil))
+        for i in range(0, len(xyzr), chunk_size):
+            chunk = xyzr[i:i + chunk_size]
+            center_cells = np.floor((chunk[:, 0:3] - self.origin) / spacing).astype(int)
+            cells = center_cells[:, None, :] + stencil[None, :, :]
+            centers = self.origin + (cells + 0.5) * spacing
+            dist2 = ((centers - chunk[:, None, 0:3]) ** 2).sum(axis=-1)
+            inside = dist2 <= chunk[:, None, 3] ** 2
+            cells = cells[inside]
+            cells = cells[((cells >= 0) & (cells < self.shape)).all(axis=1)]
+            self.grid[cells[:, 0], cells[:, 1], cells[:, 2]] = True
+
+        self.flat = self.grid.ravel()
+        self.strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1])
+
+    def lookup(self, points: np.ndarray):
+        cells = ((points - self.origin) / self.spacing).astype(np.int32)
+        np.clip(cells, 0, self.shape - 1, out=cells)
+        return self.flat[cells @ self.strides]
+
+
+def compute_native_ao(vertices, normals, xyzr, samples=32, max_dist=20.0, spacing=GRID_SPACING):
+    """Estimates per-vertex ambient occlusion by casting rays through an atom occupancy grid
+
+    samples is the number of hemisphere rays per vertex, and trades quality for speed.
+    Returns float32 values in [0, 1], where 1 is fully unoccluded.
+    """
+    if len(vertices) == 0 or len(xyzr) == 0:
+        return np.ones(len(vertices), dtype=np.float32)
+
+    grid = OccupancyGrid(xyzr, spacing)
+    hemisphere = cosine_hemisphere(samples)
+
+    steps = [spacing]
+    while steps[-1] * STEP_GROWTH < max_dist:
+        steps.append(steps[-1] * STEP_GROWTH)
+
+    ao = np.empty(len(vertices), dtype=np.float32)
+    for i in range(0, len(vertices), VERTEX_CHUNK_SIZE):
+        v = vertices[i:i + VERTEX_CHUNK_SIZE].astype(np.float64)
+        n = normals[i:i + VERTEX_CHUNK_SIZE].astype(np.float64)
+        n /= np.maximum(np.linalg.norm(n, axis=1), 1e-9)[:, None]
+        directions = hemisphere @ tangent_frames(n)
+        # lift the origin off the surface so rays don't hit the voxels it touches
+        origins = (v + n * (0.5 * spacing))[:, None, :]
+        occluded = np.zeros(directions.shape[0:2], dtype=bool)
+        for t in steps:
+            occluded |= grid.lookup(origins + directions * t)
+        # directions are cosine distributed, so every ray has the same weight
+        ao[i:i + VERTEX_CHUNK_SIZE] = 1 - occluded.mean(axis=1)
+    return ao
@@ -0,0 +1,59 @@
+import numpy as np
+
+# edge length of the grid blocks a large selection is split into, in angstrom
+BLOCK_SIZE = 40.0
+
+
+def partition_blocks(xyzr: np.ndarray, block_size=BLOCK_SIZE, margin=0.0):
+    """Splits atoms into grid blocks, each padded with the atoms within margin of it
+
+    Returns a list of (atom_indices, core_min, core_max), where the core boxes tile space
+    and atom_indices include the margin atoms shared with neighbouring blocks.
+    """
+    if len(xyzr) == 0:
+        return []
+    centers = xyzr[:, 0:3]
+    origin = centers.min(axis=0)
+    # the surface reaches past the atom centers, so include every block within margin of an atom
+    low = np.floor((centers - margin - origin) / block_size).astype(np.int64)
+    high = np.floor((centers + margin - origin) / block_size).astype(np.int64)
+    span = np.arange(int((high - low).max()) + 1)
+    offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'), axis=-1).reshape(-1, 3)
+    cells = []
+    for offset in offsets:
+        cell = low + offset
+        cells.append(cell[(cell <= high).all(axis=1)])
+    cells = np.unique(np.concatenate(cells), axis=0)
+
+    blocks = []
+    for cell in cells:
+        core_min = origin + cell * block_size
+        core_max = core_min + block_size
+        inside = ((centers >= core_min - margin) & (centers < core_max + margin)).all(axis=1)
+        blocks.append((np.flatnonzero(inside), core_min, core_max))
+    return blocks
+
+
+def trim_to_box(vertices, normals, indices, triangles, box_min, box_max):
+    """Keeps the triangles with their centroid in [box_min, box_max) and the vertices they use"""
+    centroids = vertices[triangles].mean(axis=1)
+    keep = ((centroids >= box_min) & (centroids < box_max)).all(axis=1)
+    triangles = triangles[keep]
+
+    used = np.zeros(len(vertices), dtype=bool)
+    used[triangles.ravel()] = True
+    remap = np.cumsum(used, dtype=np.int64) - 1
+    return vertices[used], normals[used], indices[used], remap[triangles].astype(np.int32)
+
+
+def merge_meshes(parts, index_offsets):
+    """Concatenates (vertices, normals, indices, triangles) parts into one mesh
+
+    index_offsets are added to each part's atom indices, triangles are shifted past the previous parts' vertices.
+    """
+    vertex_offsets = np.cumsum([0] + [len(v) for v, _, _, _ in parts[:-1]])
+    vertices = np.concatenate([v for v, _, _, _ in parts])
+    normals = np.concatenate([n for _, n, _, _ in parts])
+    indices = np.concatenate([i + offset for (_, _, i, _), offset in zip(parts, index_offsets)]).astype(np.int32)
+    triangles = np.concatenate([t + offset for (_, _, _, t), offset in zip(parts, vertex_offsets)]).astype(np.int32)
+    return vertices, normals, indices, triangles
@@ -0,0 +1,32 @@
+import numpy as np
+
+# molecular surface area of a fragment, about AREA_SCALE * atoms ^ AREA_EXPONENT square angstrom
+# (area ~ 4.84 * mass ^ 0.76 for proteins, with ~14 Da per heavy atom)
+AREA_SCALE = 36.0
+AREA_EXPONENT = 0.76
+# vertices of all fragments of a surface, MSMS density is in vertices per square angstrom
+MAX_SURFACE_VERTICES = 1500000
+MIN_DENSITY = 1.0
+# planned densities are rounded down to one of these, so small edits elsewhere keep fragment cache keys
+DENSITY_LEVELS = [10.0, 7.0, 5.0, 3.5, 2.5, 1.75, 1.25, MIN_DENSITY]
+
+
+def estimate_area(num_atoms):
+    return AREA_SCALE * np.power(np.asarray(num_atoms, dtype=np.float64), AREA_EXPONENT)
+
+
+def plan_densities(fragment_sizes, max_density, max_vertices=MAX_SURFACE_VERTICES):
+    """Returns an MSMS density per fragment so the estimated vertices of all fragments fit the budget
+
+    Fragments share one density, so the surface has the same detail everywhere.
+    """
+    total_area = float(estimate_area(fragment_sizes).sum())
+    density = max_density
+    if total_area * density > max_vertices:
+        fitted = max_vertices / total_area
+        density = next((level for level in DENSITY_LEVELS if level <= fitted), MIN_DENSITY)
+    return [density] * len(fragment_sizes)
+
+
+def estimate_vertices(fragment_sizes, densities):
+    return int((estimate_area(fragment_sizes) * np.asarray(densities)).sum())
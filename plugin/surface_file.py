@@ -0,0 +1,114 @@
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+# file layout: prefix, JSON header padded to HEADER_ALIGN, then the array data
+# the padding lets metadata be rewritten in place, aligned arrays can be memory mapped
+MAGIC = b'HQSURF'
+VERSION = 1
+PREFIX = struct.Struct('<6sHI')  # magic, version, header length
+HEADER_ALIGN = 4096
+ARRAY_ALIGN = 64
+COMPRESS_LEVEL = 1
+
+
+def align(n, alignment):
+    return n + -n % alignment
+
+
+def encode_header(meta, table, size=0):
+    """Returns the prefix and JSON header, padded to at least size bytes"""
+    content = json.dumps(dict(meta=meta, arrays=table), separators=(',', ':')).encode()
+    size = max(size, align(PREFIX.size + len(content), HEADER_ALIGN))
+    return PREFIX.pack(MAGIC, VERSION, size - PREFIX.size) + content.ljust(size - PREFIX.size)
+
+
+def write_surface_file(path, meta: dict, arrays: 'dict[str, np.ndarray]', compress=False):
+    """Writes named arrays and JSON metadata to a surface file
+
+    Uncompressed files can be memory mapped when read, compressed ones are deflated per array.
+    """
+    table = {}
+    blocks = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        data = array.reshape(-1).view(np.uint8)
+        if compress:
+            data = zlib.compress(data, COMPRESS_LEVEL)
+        # offsets are relative to the end of the header
+        offset = align(offset, ARRAY_ALIGN)
+        table[name] = dict(
+            dtype=array.dtype.str, shape=list(array.shape), offset=offset, size=len(data), compressed=compress)
+        blocks.append((offset, data))
+        offset += len(data)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            header = encode_header(meta, table)
+            f.write(header)
+            for offset, data in blocks:
+                f.write(b'\0' * (len(header) + offset - f.tell()))
+                f.write(data)
+        # atomic, readers never see partial files
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_surface_header(path):
+    """Returns (meta, array table, header size) of a surface file"""
+    with open(path, 'rb') as f:
+        prefix = f.read(PREFIX.size)
+        if len(prefix) < PREFIX.size:
+            raise Exception('Not a surface file')
+        magic, version, length = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise Exception('Not a surface file')
+        if version != VERSION:
+            raise Exception(f'Unsupported surface file version {version}')
+        header = json.loads(f.read(length))
+    return header['meta'], header['arrays'], PREFIX.size + length
+
+
+def read_surface_file(path, mmap=True):
+    """Returns (meta, arrays) of a surface file
+
+    Uncompressed arrays are read-only views of a memory map when mmap is set, so only the parts used are read.
+    """
+    meta, table, header_size = read_surface_header(path)
+    if mmap and not any(entry['compressed'] for entry in table.values()):
+        buffer = np.memmap(path, mode='r')
+    else:
+        with open(path, 'rb') as f:
+            buffer = f.read()
+
+    arrays = {}
+    for name, entry in table.items():
+        dtype = np.dtype(entry['dtype'])
+        start = header_size + entry['offset']
+        data = buffer[start:start + entry['size']]
+        if entry['compressed']:
+            data = zlib.decompress(data)
+        arrays[name] = np.frombuffer(data, dtype=dtype).reshape(entry['shape'])
+    return meta, arrays
+
+
+def update_surface_meta(path, meta: dict):
+    """Replaces the metadata of a surface file, in place when it fits in the header padding"""
+    _, table, header_size = read_surface_header(path)
+    header = encode_header(meta, table, header_size)
+    if len(header) == header_size:
+        with open(path, 'r+b') as f:
+            f.write(header)
+        return
+    _, arrays = read_surface_file(path, mmap=False)
+    compress = any(entry['compressed'] for entry in table.values())
+    write_surface_file(path, meta, arrays, compress)
@@ -1,6 +1,136 @@
+import asyncio
+import functools
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# threads for CPU bound work off the event loop, numpy and file I/O mostly release the GIL
+worker_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='surface-worker')
+# rows formatted at once by write_rows
+WRITE_CHUNK_ROWS = 65536
+
 
 def natural_sorted(l):
     convert = lambda text: int(text) if text.isdigit() else text
     natural_key = lambda key: [convert(c) for c in re.split('(\d+)', key)]
     return sorted(l, key=natural_key)
+
+
+def contiguous_ranges(keys):
+    """Returns (start, end) index ranges of consecutive equal values in an array"""
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    ends = np.append(starts[1:], len(keys))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+# (limit, usage) files of the container memory cgroup, v2 then v1
+CGROUP_MEMORY_FILES = [
+    ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+    ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'),
+]
+
+
+def cgroup_memory():
+    """Returns the memory left under the cgroup limit in bytes, or None if no limit is set"""
+    for limit_path, usage_path in CGROUP_MEMORY_FILES:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            if limit == 'max':
+                return None
+            with open(usage_path) as f:
+                return max(int(limit) - int(f.read()), 0)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def write_rows(f, line_format, rows: np.ndarray):
+    """Writes line_format for each row of a 2D array, formatting whole chunks with one % operation"""
+    for i in range(0, len(rows), WRITE_CHUNK_ROWS):
+        chunk = rows[i:i + WRITE_CHUNK_ROWS]
+        f.write((line_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict_files(directory, extension, max_size, keep=()):
+    """Removes the least recently modified files with this extension until the rest fit in max_size bytes
+
+    Paths in keep are never removed.
+    """
+    stats = []
+    try:
+        for e in os.scandir(directory):
+            if e.name.endswith(extension):
+                stats.append((e.path, e.stat()))
+    except OSError:
+        # missing, or another plugin process evicted concurrently, retry next time
+        return
+    total = sum(st.st_size for _, st in stats)
+    for path, st in sorted(stats, key=lambda s: s[1].st_mtime):
+        if total <= max_size:
+            break
+        if path in keep:
+            continue
+        remove_file(path)
+        total -= st.st_size
+
+
+def available_memory():
+    """Returns the memory available for new allocations in bytes, or None if unknown
+
+    A container memory limit counts when it is lower than the free memory of the host.
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    if memory is None:
+        try:
+            memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            pass
+    limited = cgroup_memory()
+    if limited is None:
+        return memory
+    return limited if memory is None else min(memory, limited)
+
+
+def process_exists(pid):
+    """Returns whether a process with this id is running, on windows only the own process is known"""
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+async def run_in_worker(func, *args, **kwargs):
+    """Runs func in the worker pool and resumes on the event loop with its result
+
+    func must not modify SDK objects, the caller applies its result once back on the loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(worker_pool, functools.partial(func, *args, **kwargs))
@@ -1,4 +1,10 @@
+import sys
+
 from plugin import HighQualitySurfaces
 
 if __name__ == "__main__":
-    HighQualitySurfaces.main()
+    if sys.argv[1:2] == ['batch']:
+        from plugin import batch
+        batch.main(sys.argv[2:])
+    else:
+        HighQualitySurfaces.main()